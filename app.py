@@ -14,7 +14,7 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
 # Note: we need to import app before decorators or it won't work
-from frestq.app import app
+from frestq.app import app, db
 from frestq import decorators
 
 logging.basicConfig(level=logging.DEBUG)
@@ -45,6 +45,7 @@ SQLALCHEMY_DATABASE_URI = 'sqlite:///%s/db.sqlite' % ROOT_PATH
 
 PRIVATE_DATA_PATH = os.path.join(ROOT_PATH, 'datastore/private')
 PUBLIC_DATA_PATH = os.path.join(ROOT_PATH, 'datastore/public')
+ARCHIVE_DATA_PATH = os.path.join(ROOT_PATH, 'datastore/archive')
 
 import models
 import reject_adapter
@@ -53,14 +54,46 @@ import create_election.performer_jobs
 import tally_election.director_jobs
 import tally_election.performer_jobs
 from public_api import public_api
+from public_data import public_data
 from taskqueue import start_queue
+from db_profiles import apply_db_profile
 
 
 def extra_parse_args(self, parser):
     parser.add_argument("--reset-tally", help="Enable making a second tally for :election_id",
                         type=int)
+    parser.add_argument("--migrate", help="Apply the pending database migrations",
+                        action="store_true")
+    parser.add_argument("--archive", help="Archive the finished elections",
+                        action="store_true")
+    parser.add_argument("--archive-election", help="Archive :election_id",
+                        type=int)
+    parser.add_argument("--restore-election", help="Restore the archived :election_id",
+                        type=int)
 
 def extra_run(self):
+    if self.pargs.migrate:
+        import migrations
+        applied = migrations.migrate(db.engine)
+        print("%d migrations applied" % len(applied))
+        return True
+
+    if self.pargs.archive:
+        import archive
+        archived = archive.archive_finished_elections()
+        print("%d elections archived" % len(archived))
+        return True
+
+    if self.pargs.archive_election is not None:
+        import archive
+        archive.archive_election(self.pargs.archive_election)
+        return True
+
+    if self.pargs.restore_election is not None:
+        import archive
+        archive.restore_election(self.pargs.restore_election)
+        return True
+
     if self.pargs.reset_tally and isinstance(self.pargs.reset_tally,int):
         election_id = self.pargs.reset_tally
         tally_election.performer_jobs.reset_tally(election_id)
@@ -70,15 +103,44 @@ def extra_run(self):
 
 if __name__ == "__main__":
     app.configure_app(scheduler=False, config_object=__name__)
+    apply_db_profile(app, db)
     app.register_blueprint(public_api, url_prefix='/public_api')
+    app.register_blueprint(public_data, url_prefix='/public_data')
     if len(sys.argv) == 3 and sys.argv[1] == "create-tarball":
         from tools import create_tarball
         create_tarball.create(sys.argv[2])
         exit(0)
+    if len(sys.argv) >= 3 and sys.argv[1] == "create-tarball-batch":
+        import json
+        import argparse
+        import contextlib
+        from tools import create_tarball
+        parser = argparse.ArgumentParser(prog="app.py create-tarball-batch")
+        parser.add_argument("election_ids", nargs="+",
+            help="election ids or ranges of them, like 1 5-8 10,12")
+        parser.add_argument("--jobs", type=int, default=4,
+            help="number of elections processed in parallel")
+        parser.add_argument("--output",
+            help="write the JSON report to this file instead of stdout")
+        pargs = parser.parse_args(sys.argv[2:])
+        election_ids = create_tarball.parse_election_ids(pargs.election_ids)
+        # the progress printed while creating the tarballs goes to stderr,
+        # so that stdout only has the JSON report
+        with contextlib.redirect_stdout(sys.stderr):
+            report = create_tarball.create_batch(election_ids, pargs.jobs)
+        report_s = json.dumps(report, indent=4)
+        if pargs.output:
+            with open(pargs.output, 'w') as output_file:
+                output_file.write(report_s)
+        else:
+            print(report_s)
+        exit(1 if report['failed'] else 0)
     app.run(parse_args=True, extra_parse_func=extra_parse_args, 
             extra_run=extra_run)
 else:
     app.configure_app(config_object=__name__)
+    apply_db_profile(app, db)
     app.register_blueprint(public_api, url_prefix='/public_api')
+    app.register_blueprint(public_data, url_prefix='/public_data')
     start_queue()
 
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, and_, exists
+
+from frestq.app import app, db
+from frestq.tasks import TaskError
+from models import (Election, Session, Authority, Ballot, TallyCheckpoint,
+    QueryQueue, ElectionArchive, archived_election, archived_session,
+    archived_authority, archived_ballot, archived_tally_checkpoint)
+from keys_management import (assert_private_key_file_hashes,
+    get_session_private_key_path, get_file_hash_path, read_text_file)
+from authorities import forget_election_authorities
+from questions_cache import invalidate_questions
+from sha256 import HashingWriter
+from tools.create_tarball import (DeterministicTarWriter, hash_file,
+    extract_tar_file)
+from tally_checkpoints import get_checkpoint, PUBLISHED_PHASE
+from tally_election.performer_jobs import get_tally_file_path
+from utils import mkdir_recursive
+
+# Finished elections are moved out of the hot tables into archived_* tables
+# with the same columns, and their private data directory is packed into a
+# deterministic tar.gz bundle in ARCHIVE_DATA_PATH. The rows of an election
+# are moved in parent first order when restoring it and in the reverse order
+# when archiving it. Ballots are moved apart, in chunks.
+ELECTION_TABLES = [
+    (Election.__table__, archived_election, 'id'),
+    (Session.__table__, archived_session, 'election_id'),
+    (Authority.__table__, archived_authority, 'election_id'),
+    (TallyCheckpoint.__table__, archived_tally_checkpoint, 'election_id'),
+]
+
+def get_bundle_path(election_id):
+    archive_data_path = app.config.get('ARCHIVE_DATA_PATH', '')
+    return os.path.join(archive_data_path, '%d.tar.gz' % election_id)
+
+
+def get_election_privpath(election_id):
+    private_data_path = app.config.get('PRIVATE_DATA_PATH', '')
+    return os.path.join(private_data_path, str(election_id))
+
+
+def get_archivable_elections(limit):
+    '''
+    Returns the ids of up to limit elections that can be archived: those
+    without queued jobs whose tally was published more than
+    ARCHIVE_AFTER_DAYS ago, as recorded by its published checkpoint
+    '''
+    days = app.config.get('ARCHIVE_AFTER_DAYS', 90)
+    limit_date = datetime.utcnow() - timedelta(days=days)
+
+    candidates = db.session.query(Election.id)\
+        .join(TallyCheckpoint, and_(
+            TallyCheckpoint.election_id == Election.id,
+            TallyCheckpoint.session_id == '',
+            TallyCheckpoint.phase == PUBLISHED_PHASE
+        ))\
+        .filter(TallyCheckpoint.created_at < limit_date)\
+        .filter(~exists().where(QueryQueue.election_id == Election.id))\
+        .order_by(Election.id)\
+        .limit(limit)
+    return [election_id for election_id, in candidates]
+
+
+def move_rows(source, target, where):
+    '''
+    Moves the rows of source matching where into target, which has the same
+    columns, and returns how many were moved. It's not committed.
+    '''
+    db.session.execute(target.insert().from_select(
+        [column.name for column in source.columns],
+        select([source]).where(where)
+    ))
+    return db.session.execute(source.delete().where(where)).rowcount
+
+
+def move_session_ballots(session_id, source, target, chunk_size):
+    '''
+    Moves the ballots of a session between the ballot and the
+    archived_ballot tables, committing each chunk of at most chunk_size
+    '''
+    while True:
+        chunk = select([source.c.ballot_hash])\
+            .where(source.c.session_id == session_id)\
+            .order_by(source.c.ballot_hash)\
+            .limit(chunk_size)
+        moved = move_rows(source, target, and_(
+            source.c.session_id == session_id,
+            source.c.ballot_hash.in_(chunk)
+        ))
+        db.session.commit()
+        if moved < chunk_size:
+            return
+
+
+def check_key_shares(election_id, session_ids):
+    '''
+    Checks the key shares still present against their sha256 files, writing
+    the missing ones, as keys_management does before handing them out. Shares
+    already deleted with keys_management.delete_private_share only keep their
+    hash file, and are restored with restore_private_share.
+    '''
+    present_ids = [
+        session_id
+        for session_id in session_ids
+        if os.path.exists(get_session_private_key_path(election_id,
+            session_id))
+    ]
+    msg, code = assert_private_key_file_hashes(election_id, present_ids)
+    if code != 200:
+        raise TaskError(dict(reason=msg))
+
+
+def check_bundle_key_shares(bundle_privpath, session_ids):
+    '''
+    Checks the key shares extracted from a bundle against their sha256 files
+    '''
+    for session_id in session_ids:
+        key_path = os.path.join(bundle_privpath, session_id, 'privInfo.xml')
+        hash_path = get_file_hash_path(key_path)
+        if not os.path.exists(key_path):
+            continue
+        if not os.path.exists(hash_path) or\
+                read_text_file(hash_path) != hash_file(key_path, mode='rb'):
+            raise TaskError(dict(reason='private key file of session %s has '
+                'a hash consistency error' % session_id))
+
+
+def write_bundle(election_id, election_privpath):
+    '''
+    Packs the private data of an election into its bundle, returning its
+    path, hash and size
+    '''
+    bundle_path = get_bundle_path(election_id)
+    bundle_dir = os.path.dirname(bundle_path)
+    if not os.path.exists(bundle_dir):
+        mkdir_recursive(bundle_dir)
+
+    tmp_path = bundle_path + '.tmp'
+    with open(tmp_path, 'wb') as bundle_file:
+        writer = HashingWriter(bundle_file)
+        with DeterministicTarWriter(writer, os.path.basename(bundle_path))\
+                as tar:
+            tar.add(election_privpath, str(election_id))
+        bundle_file.flush()
+        os.fsync(bundle_file.fileno())
+    os.rename(tmp_path, bundle_path)
+    return bundle_path, writer.hexdigest(), writer.size
+
+
+def get_archive(election_id):
+    return db.session.query(ElectionArchive)\
+        .filter(ElectionArchive.election_id == election_id)\
+        .first()
+
+
+def archive_election(election_id):
+    '''
+    Moves the rows of a finished election to the archive tables and its
+    private data directory to a cold storage bundle. Elections with queued
+    jobs or without a published tally are refused.
+
+    The ElectionArchive row is written first in the "archiving" state, so
+    that the election can't be queued meanwhile, and an interrupted archival
+    is resumed by calling this again.
+    '''
+    archive = get_archive(election_id)
+    if archive is not None and archive.state == 'restoring':
+        raise TaskError(dict(reason="election is being restored"))
+
+    election_privpath = get_election_privpath(election_id)
+    if archive is None:
+        if db.session.query(Election.id)\
+                .filter(Election.id == election_id).first() is None:
+            raise TaskError(dict(reason="election not created"))
+
+        # checked again, as the election might have changed since it was
+        # listed by get_archivable_elections
+        if db.session.query(QueryQueue.id)\
+                .filter(QueryQueue.election_id == election_id)\
+                .first() is not None:
+            raise TaskError(dict(reason="election has queued jobs"))
+        if get_checkpoint(election_id, '', PUBLISHED_PHASE) is None or\
+                not os.path.exists(get_tally_file_path(election_id)):
+            raise TaskError(dict(reason="election tally not published"))
+
+        archive = ElectionArchive(election_id=election_id, state='archiving')
+        db.session.add(archive)
+        db.session.commit()
+
+    if archive.state == 'archiving':
+        session_ids = [
+            session_id
+            for session_id, in db.session.query(Session.id)\
+                .filter(Session.election_id == election_id)
+        ]
+        if os.path.exists(election_privpath):
+            check_key_shares(election_id, session_ids)
+            archive.bundle_path, archive.bundle_hash, archive.bundle_size =\
+                write_bundle(election_id, election_privpath)
+            db.session.commit()
+
+        chunk_size = app.config.get('ARCHIVE_CHUNK_SIZE', 10000)
+        for session_id in session_ids:
+            move_session_ballots(session_id, Ballot.__table__,
+                archived_ballot, chunk_size)
+
+        for source, target, column in reversed(ELECTION_TABLES):
+            move_rows(source, target, source.c[column] == election_id)
+        archive.state = 'archived'
+        archive.archived_at = datetime.utcnow()
+        db.session.commit()
+
+    if archive.bundle_path is not None and os.path.exists(election_privpath):
+        shutil.rmtree(election_privpath)
+    forget_election_authorities(election_id)
+    invalidate_questions(election_id)
+
+
+def restore_election(election_id):
+    '''
+    Moves back the rows of an archived election to the hot tables and
+    extracts its private data from its bundle.
+
+    The ElectionArchive row is kept in the "restoring" state until
+    everything is restored, so an interrupted restore is resumed by calling
+    this again.
+    '''
+    archive = get_archive(election_id)
+    if archive is None:
+        raise TaskError(dict(reason="election not archived"))
+    if archive.state == 'archiving':
+        raise TaskError(dict(reason="election archival was interrupted, "
+            "archive it again to finish it"))
+
+    election_privpath = get_election_privpath(election_id)
+    if archive.state == 'archived':
+        if os.path.exists(election_privpath):
+            raise TaskError(dict(reason="private data of the election "
+                "already exists at %s" % election_privpath))
+        archive.state = 'restoring'
+        db.session.commit()
+
+    session_ids = [
+        session_id
+        for session_id, in db.session.query(archived_session.c.id)\
+            .filter(archived_session.c.election_id == election_id)
+    ] + [
+        session_id
+        for session_id, in db.session.query(Session.id)\
+            .filter(Session.election_id == election_id)
+    ]
+
+    # the private data is restored first, as the directory only appears once
+    # it's complete
+    if archive.bundle_path is not None and\
+            not os.path.exists(election_privpath):
+        if hash_file(archive.bundle_path, mode='rb') != archive.bundle_hash:
+            raise TaskError(dict(reason="bundle hash mismatch"))
+        private_data_path = app.config.get('PRIVATE_DATA_PATH', '')
+        extract_path = tempfile.mkdtemp(dir=private_data_path)
+        try:
+            extract_tar_file(archive.bundle_path, extract_path)
+            check_bundle_key_shares(
+                os.path.join(extract_path, str(election_id)), session_ids)
+            os.rename(os.path.join(extract_path, str(election_id)),
+                election_privpath)
+        finally:
+            shutil.rmtree(extract_path)
+
+    for target, source, column in ELECTION_TABLES:
+        move_rows(source, target, source.c[column] == election_id)
+    db.session.commit()
+
+    chunk_size = app.config.get('ARCHIVE_CHUNK_SIZE', 10000)
+    for session_id in session_ids:
+        move_session_ballots(session_id, archived_ballot, Ballot.__table__,
+            chunk_size)
+
+    bundle_path = archive.bundle_path
+    db.session.delete(archive)
+    db.session.commit()
+    if bundle_path is not None and os.path.exists(bundle_path):
+        os.remove(bundle_path)
+
+
+def archive_finished_elections():
+    '''
+    Archives up to ARCHIVE_BATCH_SIZE finished elections (see
+    get_archivable_elections), returning the ids of those archived
+    '''
+    limit = app.config.get('ARCHIVE_BATCH_SIZE', 100)
+    archived = []
+    for election_id in get_archivable_elections(limit):
+        try:
+            archive_election(election_id)
+            archived.append(election_id)
+        except Exception as e:
+            db.session.rollback()
+            print("ERROR archiving election %d" % election_id, e)
+    return archived
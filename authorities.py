@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+import threading
+
+from frestq.app import app, db
+from models import Authority
+from utils import cert_fingerprint
+
+# (election_id, fingerprint) pairs of the known authorities of each
+# election. Only positive results are cached, as authorities are never
+# removed from an election but an election might not be created yet
+authorities_cache = set()
+authorities_cache_lock = threading.Lock()
+
+def is_election_authority(election_id, ssl_cert):
+    '''
+    Returns True if the given certificate is the one of an authority of the
+    election. Used to authenticate the sender of a task.
+    '''
+    fingerprint = cert_fingerprint(ssl_cert)
+    if fingerprint is None:
+        return False
+
+    key = (election_id, fingerprint)
+    with authorities_cache_lock:
+        if key in authorities_cache:
+            return True
+
+    # the fingerprints of the authorities created before they were stored are
+    # set by the authority_fingerprint migration
+    if not has_authority_fingerprint(election_id, fingerprint):
+        return False
+
+    with authorities_cache_lock:
+        max_size = app.config.get('AUTHORITIES_CACHE_SIZE', 10000)
+        if len(authorities_cache) >= max_size:
+            authorities_cache.clear()
+        authorities_cache.add(key)
+    return True
+
+
+def has_authority_fingerprint(election_id, fingerprint):
+    return db.session.query(Authority.id)\
+        .filter(Authority.election_id == election_id)\
+        .filter(Authority.fingerprint == fingerprint)\
+        .first() is not None
+
+
+def forget_election_authorities(election_id):
+    '''
+    Removes from the cache the authorities of an election, for when it's
+    deleted
+    '''
+    with authorities_cache_lock:
+        for key in [key for key in authorities_cache if key[0] == election_id]:
+            authorities_cache.discard(key)
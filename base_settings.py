@@ -31,6 +31,11 @@ PRIVATE_DATA_PATH = os.path.join(ROOT_PATH, 'datastore/private')
 PUBLIC_DATA_PATH = '/srv/election-orchestra/server1/public'
 PUBLIC_DATA_BASE_URL = 'https://127.0.0.1:5000/public_data'
 
+# how files are published from PRIVATE_DATA_PATH into PUBLIC_DATA_PATH: one of
+# "hardlink", "reflink" or "copy". If the method cannot be used, for example
+# because both paths are in different filesystems, it falls back to a copy.
+PUBLISH_FILE_MODE = 'reflink'
+
 # security configuration
 SSL_CERT_PATH = '%s/certs/selfsigned/cert.pem' % ROOT_PATH
 SSL_KEY_PATH = '%s/certs/selfsigned/key-nopass.pem' % ROOT_PATH
@@ -52,4 +57,115 @@ QUEUES_OPTIONS = {
     }
 }
 
+# maximum number of queued election creations and tallies running at the same
+# time, globally and per task type. Jobs of the same election are always run
+# one after the other. Note that the mixnet itself is still serialized by the
+# mixnet_queue of QUEUES_OPTIONS.
+QUEUE_MAX_RUNNING = 4
+QUEUE_MAX_RUNNING_PER_TASK = {
+    'election': 4,
+    'tally': 2
+}
+
+# the queue dispatcher is woken up whenever a job is queued or finished (also
+# from other processes when using Postgres, with LISTEN/NOTIFY). This is the
+# maximum number of seconds it sleeps anyway, in case a notification is lost
+QUEUE_DISPATCHER_INTERVAL = 60
+
+# running jobs are leased to the worker process that started them, which
+# renews the lease every QUEUE_HEARTBEAT_INTERVAL seconds. When a lease
+# expires because its worker died, the job is queued again, up to
+# QUEUE_MAX_ATTEMPTS times
+QUEUE_LEASE_SECONDS = 300
+QUEUE_HEARTBEAT_INTERVAL = 60
+QUEUE_MAX_ATTEMPTS = 3
+
+# priority classes of the queued jobs, with the head start in seconds that each
+# one has over jobs queued at the same time. A job of a higher class overtakes
+# older jobs of lower classes only up to the difference of their head starts,
+# so that low priority jobs are not starved.
+QUEUE_PRIORITY_CLASSES = {
+    'low': 0,
+    'normal': 3600,
+    'high': 6*3600,
+    'urgent': 7*24*3600
+}
+
+# default priority class of each type of task. It can also be set per request
+# with the "priority" query parameter of POST /election and POST /tally
+QUEUE_TASK_PRIORITIES = {
+    'election': 'normal',
+    'tally': 'high'
+}
+
 ENABLE_MULTIPLE_TALLIES = False
+
+# maximum number of ballots removed by each of the DELETE statements, committed
+# one by one, used to reset a tally (see --reset-tally)
+RESET_TALLY_CHUNK_SIZE = 10000
+
+# days the queue and phase metrics are kept, and default time window in hours
+# of GET /public_api/metrics/queue
+QUEUE_METRICS_RETENTION_DAYS = 30
+QUEUE_METRICS_WINDOW_HOURS = 24*7
+
+# upper bounds in seconds of the buckets of the queue metrics histograms
+QUEUE_METRICS_BUCKETS = [1, 5, 15, 60, 5*60, 15*60, 3600, 4*3600, 12*3600, 24*3600]
+
+# maximum number of elections accepted by a single POST /public_api/elections
+MAX_ELECTIONS_PER_BULK_REQUEST = 1000
+
+# layout of the tally tarballs requested by this node when acting as director:
+# "embedded" includes all the tally inputs in the tarball, while "referenced"
+# publishes the ciphertexts and protInfo.xml files once in
+# PUBLIC_DATA_PATH/<election_id>/objects/<sha256> and the tarball only
+# includes a manifest_json with their hashes
+TALLY_LAYOUT = 'embedded'
+
+# maximum number of (election, authority certificate) pairs remembered in
+# each process to authenticate the senders of tasks
+AUTHORITIES_CACHE_SIZE = 10000
+
+# maximum number of elections whose parsed and canonically serialized
+# questions are kept in each process
+QUESTIONS_CACHE_SIZE = 1000
+
+# database engine profile: "auto" picks "sqlite" or "postgresql" from
+# SQLALCHEMY_DATABASE_URI, and "none" leaves the engine defaults. Options set
+# in SQLALCHEMY_ENGINE_OPTIONS take precedence over the profile ones
+DB_PROFILE = 'auto'
+
+# sqlite profile: the database is always switched to WAL mode. Seconds a
+# connection waits for the write lock before failing with "database is
+# locked", the synchronous pragma, and how transactions begin. "IMMEDIATE"
+# takes the write lock at the start of every transaction, so that the queue
+# never loses a claim to a lock upgrade failure. "DEFERRED" lets the
+# transactions that only read run concurrently, but under contention some
+# claims fail (see bench/db_contention_bench.py)
+DB_SQLITE_BUSY_TIMEOUT = 30
+DB_SQLITE_SYNCHRONOUS = 'NORMAL'
+DB_SQLITE_BEGIN_MODE = 'IMMEDIATE'
+
+# postgresql profile: connection pool of each process, and maximum seconds a
+# statement can run (0 to disable)
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 1800
+DB_STATEMENT_TIMEOUT = 300
+
+# archival of finished elections (see --archive): elections whose tally was
+# published more than ARCHIVE_AFTER_DAYS ago are moved to the archived_*
+# tables, at most ARCHIVE_BATCH_SIZE per run, and their private data is packed
+# into ARCHIVE_DATA_PATH/<election_id>.tar.gz. Ballots are moved in chunks of
+# ARCHIVE_CHUNK_SIZE rows, committed one by one
+ARCHIVE_DATA_PATH = os.path.join(ROOT_PATH, 'datastore/archive')
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_BATCH_SIZE = 100
+ARCHIVE_CHUNK_SIZE = 10000
+
+# GET /elections and GET /elections/<id>: seconds their responses are cached,
+# maximum number of responses cached in each process, and maximum page size
+ELECTION_STATUS_CACHE_SECONDS = 5
+ELECTION_STATUS_CACHE_SIZE = 1000
+ELECTION_STATUS_MAX_LIMIT = 500
@@ -8,7 +8,6 @@
 import os
 import json
 import codecs
-import shutil
 import requests
 import binascii
 import subprocess
@@ -23,26 +22,29 @@ from frestq.app import app, db
 
 from models import Election, Authority, Session
 from reject_adapter import RejectAdapter
-from utils import mkdir_recursive
+from utils import mkdir_recursive, publish_file
 from vmn import *
 
 from taskqueue import end_task
+from metrics import timed_phase
+from election_snapshot import load_election_snapshot
+from questions_cache import get_questions
  
 @decorators.local_task
 @decorators.task(action="create_election", queue="launch_task")
+@timed_phase("create_election")
 class CreateElectionTask(TaskHandler):
     def execute(self):
         task = self.task
         input_data = task.get_data()['input_data']
         election_id = input_data['election_id']
-        election = db.session.query(Election)\
-            .filter(Election.id == election_id).first()
+        election = load_election_snapshot(election_id)
 
         # 1. generate a session per question
         private_data_path = app.config.get('PRIVATE_DATA_PATH', '')
         election_private_path = os.path.join(private_data_path, str(election_id))
         sessions = []
-        questions = json.loads(election.questions)
+        questions = get_questions(election)
         i = 0
         for question in questions:
             session_id = "%d-%s" % (i, str(uuid.uuid4()))
@@ -81,6 +83,7 @@ class CreateElectionTask(TaskHandler):
         # 2. generate private info and protocol info files on each authority
         # (and for each question/session). Also, each authority might require
         # the approval of the task by its operator.
+        authorities = [a.to_dict() for a in election.authorities]
         priv_info_task = SequentialTask()
         for authority in election.authorities:
             subtask = SimpleTask(
@@ -98,7 +101,7 @@ class CreateElectionTask(TaskHandler):
                     end_date = election.end_date,
                     num_parties = election.num_parties,
                     threshold_parties = election.threshold_parties,
-                    authorities=[a.to_dict() for a in election.authorities]
+                    authorities=authorities
                 )
             )
             priv_info_task.add(subtask)
@@ -125,7 +128,8 @@ class CreateElectionTask(TaskHandler):
             queue="orchestra_director",
             data=dict(
                 election_id=election_id,
-                session_ids=[s['id'] for s in sessions]
+                session_ids=[s['id'] for s in sessions],
+                job_id=input_data.get('job_id', None)
             )
         )
         task.add(return_election_task)
@@ -135,49 +139,56 @@ class CreateElectionTask(TaskHandler):
         When an error is propagated up to here, is time to return to the sender
         that this task failed
         '''
-        try: 
-            session = requests.sessions.Session()
-            session.mount('http://', RejectAdapter())
-            input_data = self.task.get_data()['input_data']
-            election_id = input_data['election_id']
-            election = db.session.query(Election)\
-                .filter(Election.id == election_id).first()
-
-            session = requests.sessions.Session()
-            callback_url = election.callback_url
-            print("callback_url, " + callback_url)
-            fail_data = {
-                "status": "error",
-                "reference": {
-                    "election_id": election_id,
-                    "action": "POST /election"
-                },
-                "data": {
-                    "message": "election creation failed for some reason"
-                }
-            }
-            ssl_calist_path = app.config.get('SSL_CALIST_PATH', '')
-            ssl_cert_path = app.config.get('SSL_CERT_PATH', '')
-            ssl_key_path = app.config.get('SSL_KEY_PATH', '')
-            try:
-                r = session.request(
-                    'post',
-                    callback_url,
-                    data=dumps(fail_data),
-                    headers={'content-type': 'application/json'},
-                    verify=ssl_calist_path,
-                    cert=(ssl_cert_path, ssl_key_path)
-                )
-            except Exception as post_error:
-                print("exception calling to callback_url:")
-                print(post_error)
-                raise post_error
+        input_data = self.task.get_data()['input_data']
+        election_id = input_data['election_id']
+        try:
+            post_election_error(election_id)
         finally:
-            end_task()
+            end_task(election_id, 'error', input_data.get('job_id', None))
+
+
+def post_election_error(election_id):
+    '''
+    Tells the sender of an election that its creation failed
+    '''
+    election = db.session.query(Election)\
+        .filter(Election.id == election_id).first()
+
+    session = requests.sessions.Session()
+    session.mount('http://', RejectAdapter())
+    callback_url = election.callback_url
+    print("callback_url, " + callback_url)
+    fail_data = {
+        "status": "error",
+        "reference": {
+            "election_id": election_id,
+            "action": "POST /election"
+        },
+        "data": {
+            "message": "election creation failed for some reason"
+        }
+    }
+    ssl_calist_path = app.config.get('SSL_CALIST_PATH', '')
+    ssl_cert_path = app.config.get('SSL_CERT_PATH', '')
+    ssl_key_path = app.config.get('SSL_KEY_PATH', '')
+    try:
+        r = session.request(
+            'post',
+            callback_url,
+            data=dumps(fail_data),
+            headers={'content-type': 'application/json'},
+            verify=ssl_calist_path,
+            cert=(ssl_cert_path, ssl_key_path)
+        )
+    except Exception as post_error:
+        print("exception calling to callback_url:")
+        print(post_error)
+        raise post_error
 
 
 @decorators.task(action="merge_protinfo", queue="orchestra_director")
 @decorators.local_task
+@timed_phase("merge_protinfo")
 def merge_protinfo_task(task):
     '''
     Merge the protinfos for each of the sessions (one session per question),
@@ -188,9 +199,8 @@ def merge_protinfo_task(task):
     session_ids = input_data['session_ids']
 
     priv_info_task = task.get_prev()
-    election = db.session.query(Election)\
-        .filter(Election.id == election_id).first()
-    questions = json.loads(election.questions)
+    election = load_election_snapshot(election_id)
+    questions = get_questions(election)
 
     private_data_path = app.config.get('PRIVATE_DATA_PATH', '')
     election_privpath = os.path.join(private_data_path, str(election_id))
@@ -254,6 +264,7 @@ def merge_protinfo_task(task):
 
 @decorators.task(action="return_election", queue="orchestra_director")
 @decorators.local_task
+@timed_phase("return_election")
 def return_election(task):
     input_data = task.get_data()['input_data']
     election_id = input_data['election_id']
@@ -281,13 +292,13 @@ def return_election(task):
         pubkey_path2 = os.path.join(pub_session_path, 'publicKey_json')
         if not os.path.exists(pub_session_path):
             mkdir_recursive(pub_session_path)
-        shutil.copyfile(pubkey_path, pubkey_path2)
+        publish_file(pubkey_path, pubkey_path2)
 
         # publish protInfo.xml too
         session_privpath = os.path.join(privdata_path, str(election_id), session_id)
         protinfo_privpath = os.path.join(session_privpath, 'protInfo.xml')
         protinfo_pubpath = os.path.join(pub_session_path, 'protInfo.xml')
-        shutil.copyfile(protinfo_privpath, protinfo_pubpath)
+        publish_file(protinfo_privpath, protinfo_pubpath)
 
     session = requests.sessions.Session()
     session.mount('http://', RejectAdapter())
@@ -320,4 +331,4 @@ def return_election(task):
         raise e
     print("received text = ")
     print(r.text)
-    end_task()
+    end_task(election_id, job_id=input_data.get('job_id', None))
@@ -10,18 +10,20 @@ import os
 import codecs
 import subprocess
 import json
-import shutil
 import signal
 from datetime import datetime
 
 from frestq import decorators
-from frestq.utils import dumps, loads
+from frestq.utils import dumps
 from frestq.tasks import SimpleTask, ParallelTask, ExternalTask, TaskError
 from frestq.protocol import certs_differ
 from frestq.app import app, db
 
 from models import Election, Authority, Session
 from utils import *
+from metrics import timed_phase
+from election_snapshot import load_election_snapshot
+from questions_cache import get_questions
 from vmn import *
 
 def check_pipe(requirements, l):
@@ -147,6 +149,7 @@ def check_election_data(data, check_extra):
 
 
 @decorators.task(action="generate_private_info", queue="orchestra_performer")
+@timed_phase("generate_private_info")
 def generate_private_info(task):
     '''
     Generates the local private info for a new election
@@ -246,8 +249,7 @@ def generate_private_info(task):
     else:
         # if we are the director, models, dirs and stubs have been created
         # already, so we just get the election from the database
-        election = db.session.query(Election)\
-            .filter(Election.id == election_id).first()
+        election = load_election_snapshot(election_id)
 
     # only create external task if we have configured autoaccept to false in
     # settings:
@@ -264,7 +266,7 @@ def generate_private_info(task):
             'Title': election.title,
             'Description': election.description,
             'Voting period': "%s - %s" % (str_date(election.start_date), str_date(election.end_date)),
-            'Question data': loads(election.questions),
+            'Question data': get_questions(election),
             'Authorities': [auth.to_dict() for auth in election.authorities]
 	    } 
         approve_task = ExternalTask(
@@ -283,6 +285,7 @@ def generate_private_info(task):
 
 @decorators.task(action="generate_private_info_mixnet", queue="orchestra_performer")
 @decorators.local_task
+@timed_phase("generate_private_info_mixnet")
 def generate_private_info_mixnet(task):
     '''
     After the task has been approved, execute mixnet to generate the
@@ -336,6 +339,7 @@ def generate_private_info_mixnet(task):
     task.get_parent().set_output_data(protinfos)
 
 @decorators.task(action="generate_public_key", queue="mixnet_queue")
+@timed_phase("generate_public_key")
 def generate_public_key(task):
     '''
     Generates the local private info for a new election
@@ -400,8 +404,8 @@ def generate_public_key(task):
 
     pubkey_privpath = os.path.join(session_privpath, 'publicKey_json')
     pubkey_pubpath = os.path.join(session_pubpath, 'publicKey_json')
-    shutil.copyfile(pubkey_privpath, pubkey_pubpath)
+    publish_file(pubkey_privpath, pubkey_pubpath)
 
     protinfo_privpath = os.path.join(session_privpath, 'protInfo.xml')
     protinfo_pubpath = os.path.join(session_pubpath, 'protInfo.xml')
-    shutil.copyfile(protinfo_privpath, protinfo_pubpath)
+    publish_file(protinfo_privpath, protinfo_pubpath)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+import os
+
+from sqlalchemy import create_engine, event, exc
+
+# Engine profiles for the databases supported. The "sqlite" profile uses WAL
+# so that readers don't block the writer, and a busy timeout so that
+# concurrent writers wait for their turn instead of failing with "database is
+# locked". The "postgresql" profile sizes the connection pool and bounds the
+# duration of every statement.
+
+def get_profile_name(uri, profile='auto'):
+    '''
+    Returns the profile to use for a database uri: "sqlite", "postgresql"
+    or None
+    '''
+    if profile is None or profile == 'none':
+        return None
+    if profile != 'auto':
+        return profile
+    scheme = uri.split(':', 1)[0].split('+', 1)[0]
+    if scheme in ['sqlite', 'postgresql', 'postgres']:
+        return 'postgresql' if scheme == 'postgres' else scheme
+    return None
+
+
+def get_engine_options(profile, config):
+    '''
+    Returns the create_engine() options of a profile
+    '''
+    if profile == 'sqlite':
+        return dict(connect_args=dict(
+            timeout=config.get('DB_SQLITE_BUSY_TIMEOUT', 30)
+        ))
+    elif profile == 'postgresql':
+        options = dict(
+            pool_size=config.get('DB_POOL_SIZE', 10),
+            max_overflow=config.get('DB_MAX_OVERFLOW', 20),
+            pool_timeout=config.get('DB_POOL_TIMEOUT', 30),
+            pool_recycle=config.get('DB_POOL_RECYCLE', 1800),
+            pool_pre_ping=True
+        )
+        statement_timeout = config.get('DB_STATEMENT_TIMEOUT', 300)
+        if statement_timeout:
+            options['connect_args'] = dict(
+                options='-c statement_timeout=%d' % (statement_timeout * 1000)
+            )
+        return options
+    return dict()
+
+
+def configure_sqlite_engine(engine, config):
+    synchronous = config.get('DB_SQLITE_SYNCHRONOUS', 'NORMAL')
+    begin_mode = config.get('DB_SQLITE_BEGIN_MODE', 'IMMEDIATE')
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        if begin_mode != 'DEFERRED':
+            # pysqlite would otherwise emit its own BEGIN before the first
+            # write, see on_begin
+            dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=%s" % synchronous)
+        cursor.close()
+
+    if begin_mode != 'DEFERRED':
+        @event.listens_for(engine, 'begin')
+        def on_begin(conn):
+            # takes the write lock when the transaction starts instead of
+            # when it first writes, so that two transactions never need to
+            # upgrade their locks at the same time
+            conn.execute("BEGIN %s" % begin_mode)
+
+
+def configure_pool_fork_safety(engine):
+    '''
+    Makes the pool discard connections opened by another process, as uwsgi
+    workers are forked after the app is loaded. They are not closed, because
+    that would end the session of the process that opened them.
+    '''
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                "connection opened by process %d, reconnecting" %
+                connection_record.info['pid']
+            )
+
+
+def configure_engine(engine, profile, config):
+    '''
+    Installs the connection events of a profile in an engine. It must be
+    called before the engine opens its first connection.
+    '''
+    if profile == 'sqlite':
+        configure_sqlite_engine(engine, config)
+
+    if profile == 'postgresql':
+        configure_pool_fork_safety(engine)
+
+
+def create_profiled_engine(uri, config, profile='auto'):
+    '''
+    Creates an engine with a profile applied, used by the tools that don't
+    go through flask-sqlalchemy
+    '''
+    profile = get_profile_name(uri, profile)
+    engine = create_engine(uri, **get_engine_options(profile, config))
+    configure_engine(engine, profile, config)
+    return engine
+
+
+def apply_db_profile(app, db):
+    '''
+    Applies the profile selected with DB_PROFILE to the engine of the app.
+    Options set explicitly in SQLALCHEMY_ENGINE_OPTIONS take precedence.
+    '''
+    profile = get_profile_name(
+        app.config.get('SQLALCHEMY_DATABASE_URI', ''),
+        app.config.get('DB_PROFILE', 'auto')
+    )
+    if profile is None:
+        return
+
+    options = get_engine_options(profile, app.config)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', dict()))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    with app.app_context():
+        configure_engine(db.engine, profile, app.config)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+from collections import namedtuple
+
+from frestq.app import db
+from models import Election, Session, Authority
+
+class SessionSnapshot(namedtuple('SessionSnapshot', [
+        'id', 'election_id', 'question_number', 'status', 'public_key'])):
+    __slots__ = ()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'election_id': self.election_id,
+            'status': self.status,
+            'public_key': self.public_key,
+            'question_number': self.question_number
+        }
+
+
+class AuthoritySnapshot(namedtuple('AuthoritySnapshot', [
+        'id', 'name', 'ssl_cert', 'fingerprint', 'orchestra_url',
+        'election_id'])):
+    __slots__ = ()
+
+    def to_dict(self):
+        '''
+        Same as models.Authority.to_dict
+        '''
+        return {
+            'id': self.id,
+            'name': self.name,
+            'ssl_cert': self.ssl_cert,
+            'orchestra_url': self.orchestra_url,
+            'election_id': self.election_id
+        }
+
+
+# read-only copy of an election with its sessions, ordered by question
+# number, and its authorities, ordered by id
+ElectionSnapshot = namedtuple('ElectionSnapshot', [
+    'id', 'title', 'description', 'questions', 'start_date', 'end_date',
+    'status', 'callback_url', 'num_parties', 'threshold_parties',
+    'sessions', 'authorities'])
+
+def load_election_snapshot(election_id):
+    '''
+    Loads an election with its sessions and authorities in a single query,
+    instead of querying the lazy='dynamic' relationships each time they are
+    used. Returns None if the election doesn't exist.
+
+    The snapshot is immutable and detached from the db session, so it can be
+    shared by all the steps of a task handler, which must still use the
+    models to modify the election.
+    '''
+    rows = db.session.query(Election, Session, Authority)\
+        .outerjoin(Session, Session.election_id == Election.id)\
+        .outerjoin(Authority, Authority.election_id == Election.id)\
+        .filter(Election.id == election_id)\
+        .all()
+    if not rows:
+        return None
+
+    election = rows[0][0]
+    sessions = dict()
+    authorities = dict()
+    for _, session, authority in rows:
+        if session is not None and session.id not in sessions:
+            sessions[session.id] = SessionSnapshot(
+                id=session.id,
+                election_id=session.election_id,
+                question_number=session.question_number,
+                status=session.status,
+                public_key=session.public_key
+            )
+        if authority is not None and authority.id not in authorities:
+            authorities[authority.id] = AuthoritySnapshot(
+                id=authority.id,
+                name=authority.name,
+                ssl_cert=authority.ssl_cert,
+                fingerprint=authority.fingerprint,
+                orchestra_url=authority.orchestra_url,
+                election_id=authority.election_id
+            )
+
+    return ElectionSnapshot(
+        id=election.id,
+        title=election.title,
+        description=election.description,
+        questions=election.questions,
+        start_date=election.start_date,
+        end_date=election.end_date,
+        status=election.status,
+        callback_url=election.callback_url,
+        num_parties=election.num_parties,
+        threshold_parties=election.threshold_parties,
+        sessions=tuple(sorted(
+            sessions.values(),
+            key=lambda session: session.question_number or 0
+        )),
+        authorities=tuple(sorted(
+            authorities.values(),
+            key=lambda authority: authority.id
+        ))
+    )
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+import time
+import threading
+from collections import defaultdict
+
+from sqlalchemy.orm import defer
+
+from frestq.app import app, db
+from models import Election, Session, Authority
+
+# Read-only listing of elections and their sessions for the status endpoints
+# of public_api. Pages are selected with keyset pagination on the election
+# id, so that any page costs the same no matter how many elections there
+# are, and the large columns of the elections are never loaded.
+
+# responses by request, as (expiration time, response)
+status_cache = dict()
+status_cache_lock = threading.Lock()
+
+def get_cached(key, build):
+    '''
+    Returns the response cached for key, building and caching it with
+    build() if it's missing or older than ELECTION_STATUS_CACHE_SECONDS
+    '''
+    ttl = app.config.get('ELECTION_STATUS_CACHE_SECONDS', 5)
+    now = time.monotonic()
+    with status_cache_lock:
+        cached = status_cache.get(key, None)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+    value = build()
+    if ttl <= 0:
+        return value
+    with status_cache_lock:
+        max_size = app.config.get('ELECTION_STATUS_CACHE_SIZE', 1000)
+        if len(status_cache) >= max_size:
+            for cached_key in [k for k, v in status_cache.items() if v[0] <= now]:
+                del status_cache[cached_key]
+            if len(status_cache) >= max_size:
+                status_cache.clear()
+        status_cache[key] = (now + ttl, value)
+    return value
+
+
+def get_authorities_by_election(election_ids):
+    '''
+    Returns the authorities of the given elections as dicts, by election id,
+    with a single query
+    '''
+    ret = defaultdict(list)
+    if not election_ids:
+        return ret
+    authorities = db.session.query(Authority)\
+        .filter(Authority.election_id.in_(election_ids))\
+        .order_by(Authority.id)
+    for authority in authorities:
+        ret[authority.election_id].append(authority.to_dict())
+    return ret
+
+
+def list_elections(status=None, created_after=None, created_before=None,
+                   after_id=None, limit=50, full=False):
+    '''
+    Returns a page of up to limit elections with an id greater than
+    after_id, in id order, optionally filtered by status and creation date,
+    and the after_id of the next page, None if this is the last one
+    '''
+    query = db.session.query(Election)\
+        .options(defer(Election.description), defer(Election.questions))
+    if status is not None:
+        query = query.filter(Election.status.in_(status))
+    if created_after is not None:
+        query = query.filter(Election.created_at >= created_after)
+    if created_before is not None:
+        query = query.filter(Election.created_at < created_before)
+    if after_id is not None:
+        query = query.filter(Election.id > after_id)
+
+    elections = query.order_by(Election.id).limit(limit + 1).all()
+    next_after_id = elections[limit - 1].id if len(elections) > limit\
+        else None
+    elections = elections[:limit]
+
+    ret = [election.to_dict() for election in elections]
+    if full:
+        authorities = get_authorities_by_election(
+            [election.id for election in elections])
+        for election in ret:
+            election['authorities'] = authorities[election['id']]
+    return ret, next_after_id
+
+
+def get_election_status(election_id):
+    '''
+    Returns the election with its authorities and its sessions in question
+    order, or None if it doesn't exist
+    '''
+    election = db.session.query(Election)\
+        .options(defer(Election.description), defer(Election.questions))\
+        .filter(Election.id == election_id)\
+        .first()
+    if election is None:
+        return None
+
+    ret = election.to_dict()
+    ret['authorities'] = get_authorities_by_election([election_id])[
+        election_id]
+    ret['sessions'] = [
+        session.to_dict()
+        for session in db.session.query(Session)\
+            .filter(Session.election_id == election_id)\
+            .order_by(Session.question_number)
+    ]
+    return ret
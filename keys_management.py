@@ -8,7 +8,8 @@ import tempfile
 from models import Session
 import os
 import shutil
-from tools.create_tarball import hash_file, hash_bytes, create_deterministic_tar_file, extract_tar_file
+from tools.create_tarball import hash_file, hash_bytes, extract_tar_file, DeterministicTarWriter
+from sha256 import HashingWriter
 from flask import request, make_response
 import base64
 
@@ -47,21 +48,58 @@ def write_binary_file(file_path, bytes):
     with open(file_path, 'wb') as file:
         file.write(bytes)
 
-def create_tar_for_private_keys(election_id, session_ids):
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        for session_id in session_ids:
+class ChunkBuffer(object):
+    '''
+    Write-only file object that keeps the data written to it until it's taken
+    '''
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_private_keys_tar(election_id, session_ids):
+    '''
+    Generates the deterministic tar.gz with the private key of each session as
+    <session_id>/privInfo.xml, in chunks, without keeping it in memory or
+    copying the keys to a temporary directory
+    '''
+    private_data_path = app.config.get('PRIVATE_DATA_PATH', '')
+    election_private_path = os.path.join(private_data_path, str(election_id))
+    buffer = ChunkBuffer()
+    with DeterministicTarWriter(buffer, "private_keys.tar.gz") as tar:
+        # same entries and order as adding a directory with a copy of the keys
+        tar.add(election_private_path, '', recursive=False)
+        for session_id in sorted(session_ids):
             session_privpath = get_session_private_key_path(election_id, session_id)
-            os.mkdir(os.path.join(tmpdirname, session_id), 0o755)
-            copy_privpath = os.path.join(tmpdirname, session_id, 'privInfo.xml')
-            shutil.copyfile(session_privpath, copy_privpath)
-        
-        # create and return tar file
-        with tempfile.TemporaryDirectory() as tmp_tar_folder:
-            tar_filename = "private_keys.tar.gz"
-            tar_file_path = os.path.join(tmp_tar_folder, tar_filename)
-            create_deterministic_tar_file(tar_file_path, tmpdirname)
-            #return base64_encode_file(tar_file_path)
-            return read_binary_file(tar_file_path)
+            tar.add(os.path.dirname(session_privpath), session_id,
+                recursive=False)
+            tar.add(session_privpath, os.path.join(session_id, 'privInfo.xml'))
+            yield buffer.take()
+    yield buffer.take()
+
+def iter_base64(chunks):
+    '''
+    Encodes a stream of chunks in base64, giving the same result as encoding
+    all of them at once
+    '''
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        length = len(pending) - len(pending) % 3
+        if length:
+            yield base64.b64encode(pending[:length])
+            pending = pending[length:]
+    yield base64.b64encode(pending)
 
 def assert_private_key_file_hashes(election_id, session_ids):
     private_key_file_paths = [get_session_private_key_path(election_id, session_id) for session_id in session_ids]
@@ -86,22 +124,39 @@ def assert_private_key_file_hashes(election_id, session_ids):
     
     return (None, 200)
 
-def download_private_share(election_id):
+def download_private_share(election_id, binary=False):
     '''
-    Download private share of the keys
+    Download private share of the keys. Returns the body, which is streamed,
+    the status code and the headers of the response.
+
+    The tar.gz is generated twice, first only to compute its sha256 and size
+    so that they can be sent as headers, which is cheap as the keys are small,
+    and then to stream it. It's sent in base64 unless binary is True.
     '''
     election = get_election_by_id(election_id)
     session_ids = get_election_session_ids(election)
 
     msg, code = assert_private_key_file_hashes(election_id, session_ids)
     if code != 200:
-        return (msg, code)
-
-    # create tar file with private keys
-    tar_file_bytes = create_tar_for_private_keys(election_id, session_ids)
-    tar_file_b64 = base64.b64encode(tar_file_bytes)
-
-    return (tar_file_b64, 200)
+        return (msg, code, dict())
+
+    tar_hash = HashingWriter()
+    for chunk in iter_private_keys_tar(election_id, session_ids):
+        tar_hash.write(chunk)
+
+    headers = {'X-Archive-SHA256': tar_hash.hexdigest()}
+    chunks = iter_private_keys_tar(election_id, session_ids)
+    if binary:
+        headers['Digest'] = 'SHA-256=' + base64.b64encode(
+            tar_hash.hash.digest()).decode('utf-8')
+        headers['Content-Length'] = str(tar_hash.size)
+        headers['Content-Type'] = 'application/gzip'
+        headers['Content-Disposition'] =\
+            'attachment; filename="private_keys.tar.gz"'
+        return (chunks, 200, headers)
+
+    headers['Content-Length'] = str(4 * ((tar_hash.size + 2) // 3))
+    return (iter_base64(chunks), 200, headers)
 
 def check_private_share(election_id, private_key_base64):
     '''
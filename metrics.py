@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+import functools
+from datetime import datetime, timedelta
+from collections import Counter, defaultdict
+
+from sqlalchemy import event
+
+from frestq.app import app, db
+from models import QueryQueue, JobMetric, PhaseMetric
+
+# upper bounds in seconds of the buckets of the wait and run time histograms
+DEFAULT_METRICS_BUCKETS = [
+    1, 5, 15, 60, 5*60, 15*60, 3600, 4*3600, 12*3600, 24*3600
+]
+
+def get_metrics_buckets():
+    buckets = app.config.get('QUEUE_METRICS_BUCKETS', DEFAULT_METRICS_BUCKETS)
+    return sorted(buckets)
+
+
+def record_job_queued(job):
+    '''
+    Adds to the db session the metric of a job that has just been queued.
+    The job must have been flushed already so that it has an id.
+    '''
+    db.session.add(JobMetric(
+        job_id=job.id,
+        task=job.task,
+        election_id=job.election_id,
+        priority=job.priority,
+        queued_at=job.created_at
+    ))
+
+
+def get_open_job_metric(job_id):
+    return db.session.query(JobMetric)\
+        .filter(JobMetric.job_id == job_id)\
+        .filter(JobMetric.ended_at == None)\
+        .order_by(JobMetric.id.desc())\
+        .first()
+
+
+def record_job_started(job):
+    '''
+    Marks in the db session the start of a job that has just been claimed
+    '''
+    metric = get_open_job_metric(job.id)
+    if metric is not None:
+        metric.started_at = datetime.utcnow()
+
+
+def record_job_finished(job_id, outcome):
+    '''
+    Marks in the db session the end of a job with the given outcome
+    '''
+    metric = get_open_job_metric(job_id)
+    if metric is not None:
+        metric.ended_at = datetime.utcnow()
+        metric.outcome = outcome
+
+
+def prune_metrics():
+    '''
+    Removes the metrics older than QUEUE_METRICS_RETENTION_DAYS
+    '''
+    days = app.config.get('QUEUE_METRICS_RETENTION_DAYS', 30)
+    limit = datetime.utcnow() - timedelta(days=days)
+    db.session.query(JobMetric)\
+        .filter(JobMetric.queued_at < limit)\
+        .delete(synchronize_session=False)
+    db.session.query(PhaseMetric)\
+        .filter(PhaseMetric.started_at < limit)\
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+def insert_phase_metric(values):
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(PhaseMetric.__table__.insert(), values)
+    except Exception as e:
+        print("ERROR recording metric of phase %s" % values['action'], e)
+
+
+def record_phase(action, election_id, started_at, outcome):
+    '''
+    Stores the metric of a phase once its handler has finished, with its own
+    connection so that the transaction of the handler is left as it is. If
+    the handler left that transaction open, which might hold the sqlite write
+    lock, the metric is stored once it ends. Any error is only printed.
+    '''
+    values = dict(
+        action=action,
+        election_id=election_id,
+        started_at=started_at,
+        ended_at=datetime.utcnow(),
+        outcome=outcome
+    )
+    session = db.session()
+    transaction = session.transaction
+    # the transaction of the handler has begun once it holds a connection
+    if transaction is not None and transaction._connections:
+        event.listen(session, 'after_transaction_end',
+            lambda session, transaction: insert_phase_metric(values),
+            once=True)
+    else:
+        insert_phase_metric(values)
+
+
+def get_task_election_id(task):
+    try:
+        input_data = task.get_data()['input_data']
+        if isinstance(input_data, dict):
+            return input_data.get('election_id', None)
+    except Exception:
+        pass
+    return None
+
+
+def timed_phase(action):
+    '''
+    Decorator that records the duration and outcome of a frestq action
+    handler, either a function receiving the task or a TaskHandler class, in
+    which case its execute method is timed. Must be placed below the frestq
+    decorators.
+
+    It also renews the lease of the queued job of the election, see
+    taskqueue.renew_job_lease.
+    '''
+    def timed(func, get_task):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # imported here, as taskqueue imports this module
+            from taskqueue import renew_job_lease
+            election_id = get_task_election_id(get_task(*args))
+            try:
+                renew_job_lease(election_id)
+            except Exception as e:
+                db.session.rollback()
+                print("ERROR renewing lease of election %s" % election_id, e)
+
+            started_at = datetime.utcnow()
+            outcome = 'error'
+            try:
+                ret = func(*args, **kwargs)
+                outcome = 'success'
+                return ret
+            finally:
+                record_phase(
+                    action,
+                    election_id,
+                    started_at,
+                    outcome
+                )
+        return wrapper
+
+    def decorator(handler):
+        if isinstance(handler, type):
+            handler.execute = timed(handler.execute, lambda self, *args: self.task)
+            return handler
+        return timed(handler, lambda task, *args: task)
+    return decorator
+
+
+def histogram(values, buckets):
+    '''
+    Cumulative histogram of the given durations in seconds, in the
+    prometheus style: each bucket counts the values lower or equal than "le"
+    '''
+    counts = [0] * (len(buckets) + 1)
+    for value in values:
+        for i, bucket in enumerate(buckets):
+            if value <= bucket:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+
+    ret = []
+    total = 0
+    for bucket, count in zip(buckets + ["+Inf"], counts):
+        total += count
+        ret.append(dict(le=bucket, count=total))
+    return ret
+
+
+def summary(values, buckets):
+    return dict(
+        count=len(values),
+        mean=(sum(values) / len(values)) if values else None,
+        max=max(values) if values else None,
+        histogram=histogram(values, buckets)
+    )
+
+
+def seconds_between(start, end):
+    return (end - start).total_seconds()
+
+
+def get_queue_metrics(since):
+    '''
+    Returns the current queue depth and the aggregated wait time, run time
+    and outcomes per type of task, and the duration and outcomes of each
+    phase, for the jobs queued and the phases started since the given date
+    '''
+    buckets = get_metrics_buckets()
+
+    depth = defaultdict(lambda: dict(pending=0, running=0))
+    rows = db.session.query(QueryQueue.task, QueryQueue.doing, db.func.count())\
+        .group_by(QueryQueue.task, QueryQueue.doing)
+    for task, doing, count in rows:
+        depth[task]['running' if doing else 'pending'] += count
+
+    wait_times = defaultdict(list)
+    run_times = defaultdict(list)
+    outcomes = defaultdict(Counter)
+    rows = db.session.query(
+            JobMetric.task,
+            JobMetric.queued_at,
+            JobMetric.started_at,
+            JobMetric.ended_at,
+            JobMetric.outcome
+        )\
+        .filter(JobMetric.queued_at >= since)
+    for task, queued_at, started_at, ended_at, outcome in rows:
+        outcomes[task][outcome or 'unfinished'] += 1
+        if started_at is not None:
+            wait_times[task].append(seconds_between(queued_at, started_at))
+            if ended_at is not None:
+                run_times[task].append(seconds_between(started_at, ended_at))
+
+    durations = defaultdict(list)
+    phase_outcomes = defaultdict(Counter)
+    rows = db.session.query(
+            PhaseMetric.action,
+            PhaseMetric.started_at,
+            PhaseMetric.ended_at,
+            PhaseMetric.outcome
+        )\
+        .filter(PhaseMetric.started_at >= since)
+    for action, started_at, ended_at, outcome in rows:
+        phase_outcomes[action][outcome] += 1
+        durations[action].append(seconds_between(started_at, ended_at))
+
+    tasks = set(depth.keys()) | set(outcomes.keys())
+    return dict(
+        since=since.isoformat(),
+        depth=dict(
+            pending=sum([d['pending'] for d in depth.values()]),
+            running=sum([d['running'] for d in depth.values()])
+        ),
+        tasks=dict([
+            (task, dict(
+                depth=depth[task],
+                outcomes=dict(outcomes[task]),
+                wait_time=summary(wait_times[task], buckets),
+                run_time=summary(run_times[task], buckets)
+            ))
+            for task in tasks
+        ]),
+        phases=dict([
+            (action, dict(
+                outcomes=dict(phase_outcomes[action]),
+                duration=summary(durations[action], buckets)
+            ))
+            for action in durations.keys()
+        ])
+    )
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+from datetime import datetime
+
+from sqlalchemy import func
+
+from models import SchemaVersion
+from migrations.versions import MIGRATIONS
+
+def get_schema_version(conn):
+    '''
+    Returns the version of the last migration applied, 0 if none
+    '''
+    table = SchemaVersion.__table__
+    version = conn.execute(func.max(table.c.version).select()).scalar()
+    return version or 0
+
+
+def get_pending_migrations(engine):
+    SchemaVersion.__table__.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        current = get_schema_version(conn)
+    return [
+        (version, name, migration)
+        for version, name, migration in MIGRATIONS
+        if version > current
+    ]
+
+
+def migrate(engine):
+    '''
+    Applies the pending migrations in order, each one in its own transaction
+    together with the update of the schema version. Returns the names of the
+    migrations applied.
+    '''
+    applied = []
+    for version, name, migration in get_pending_migrations(engine):
+        print("applying migration %d: %s" % (version, name))
+        with engine.begin() as conn:
+            migration(conn)
+            conn.execute(SchemaVersion.__table__.insert().values(
+                version=version,
+                name=name,
+                applied_at=datetime.utcnow()
+            ))
+        applied.append(name)
+    return applied
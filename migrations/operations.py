@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+# Schema operations used by the migrations. All of them do nothing if the
+# change is already there, because databases created with --createdb already
+# have the current schema, and work both with SQLite and Postgres.
+
+def has_table(conn, table_name):
+    return table_name in inspect(conn).get_table_names()
+
+
+def has_column(conn, table_name, column_name):
+    return column_name in [
+        column['name']
+        for column in inspect(conn).get_columns(table_name)
+    ]
+
+
+def has_index(conn, table_name, index_name):
+    return index_name in [
+        index['name']
+        for index in inspect(conn).get_indexes(table_name)
+    ]
+
+
+def create_table(conn, table):
+    '''
+    Creates a table given its sqlalchemy Table, with its indexes
+    '''
+    table.create(conn, checkfirst=True)
+
+
+def add_column(conn, table_name, column):
+    '''
+    Adds a nullable column, given as a sqlalchemy Column, to a table
+    '''
+    if has_column(conn, table_name, column.name):
+        return
+    column_sql = CreateColumn(column).compile(dialect=conn.dialect)
+    conn.execute("ALTER TABLE %s ADD COLUMN %s" % (table_name, column_sql))
+
+
+def create_index(conn, index_name, table_name, column_names, unique=False):
+    if has_index(conn, table_name, index_name):
+        return
+    conn.execute("CREATE %sINDEX %s ON %s (%s)" % (
+        "UNIQUE " if unique else "",
+        index_name,
+        table_name,
+        ", ".join(column_names)
+    ))
+
+
+def drop_index(conn, index_name, table_name):
+    if not has_index(conn, table_name, index_name):
+        return
+    conn.execute("DROP INDEX %s" % index_name)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+import os
+from datetime import datetime
+
+from sqlalchemy import (MetaData, Table, Index, Column, BigInteger, Integer,
+    Float, DateTime, Unicode, UnicodeText, select)
+
+from frestq.app import app
+from utils import cert_fingerprint
+
+from migrations.operations import (create_table, add_column, create_index,
+    drop_index)
+
+# Each migration receives a connection inside the transaction in which it's
+# applied. Columns are given explicitly instead of taken from the models, so
+# that migrations don't change when the models do. New migrations are
+# appended at the end of MIGRATIONS with the next version number.
+
+def table(name, *args):
+    '''
+    Returns a sqlalchemy Table with its own metadata, so that it doesn't
+    clash with the table of the model
+    '''
+    return Table(name, MetaData(), *args)
+
+
+def queue_scheduling(conn):
+    add_column(conn, 'query_queue', Column('election_id', BigInteger))
+    add_column(conn, 'query_queue', Column('priority', Unicode(20)))
+    add_column(conn, 'query_queue', Column('rank', Float))
+    create_index(conn, 'ix_query_queue_doing_rank', 'query_queue',
+        ['doing', 'rank', 'id'])
+
+
+def queue_leases(conn):
+    add_column(conn, 'query_queue', Column('worker_id', Unicode(255)))
+    add_column(conn, 'query_queue', Column('lease_expires_at', DateTime))
+    add_column(conn, 'query_queue', Column('attempts', Integer))
+
+
+def queue_dedup(conn):
+    add_column(conn, 'query_queue', Column('dedup_key', Unicode(255)))
+    add_column(conn, 'query_queue', Column('extra_callback_urls', UnicodeText))
+    create_index(conn, 'ix_query_queue_dedup_key', 'query_queue',
+        ['dedup_key'], unique=True)
+
+
+def metrics_tables(conn):
+    create_table(conn, table('job_metric',
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        Column('job_id', Integer),
+        Column('task', Unicode(20)),
+        Column('election_id', BigInteger),
+        Column('priority', Unicode(20)),
+        Column('queued_at', DateTime),
+        Column('started_at', DateTime),
+        Column('ended_at', DateTime),
+        Column('outcome', Unicode(20)),
+        Index('ix_job_metric_job_id', 'job_id'),
+        Index('ix_job_metric_queued_at', 'queued_at')
+    ))
+    create_table(conn, table('phase_metric',
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        Column('action', Unicode(64)),
+        Column('election_id', BigInteger),
+        Column('started_at', DateTime),
+        Column('ended_at', DateTime),
+        Column('outcome', Unicode(20)),
+        Index('ix_phase_metric_started_at', 'started_at')
+    ))
+
+
+def tally_checkpoints(conn):
+    create_table(conn, table('tally_checkpoint',
+        Column('election_id', BigInteger, primary_key=True),
+        Column('session_id', Unicode(255), primary_key=True),
+        Column('phase', Unicode(20), primary_key=True),
+        Column('input_hash', Unicode(255)),
+        Column('output_hash', Unicode(255)),
+        Column('created_at', DateTime)
+    ))
+
+
+def authority_fingerprint(conn):
+    add_column(conn, 'authority', Column('fingerprint', Unicode(64)))
+    create_index(conn, 'ix_authority_election_fingerprint', 'authority',
+        ['election_id', 'fingerprint'])
+
+    # fingerprints of the authorities created before they were stored
+    authority = table('authority',
+        Column('id', Integer, primary_key=True),
+        Column('ssl_cert', UnicodeText),
+        Column('fingerprint', Unicode(64))
+    )
+    rows = conn.execute(select([authority.c.id, authority.c.ssl_cert])
+        .where(authority.c.fingerprint == None)).fetchall()
+    for authority_id, ssl_cert in rows:
+        conn.execute(authority.update()
+            .where(authority.c.id == authority_id)
+            .values(fingerprint=cert_fingerprint(ssl_cert)))
+
+
+def lookup_indexes(conn):
+    create_index(conn, 'ix_session_election_question', 'session',
+        ['election_id', 'question_number'])
+    create_index(conn, 'ix_query_queue_election_doing', 'query_queue',
+        ['election_id', 'doing', 'id'])
+    # replaced by ix_query_queue_election_doing
+    drop_index(conn, 'ix_query_queue_election_id', 'query_queue')
+
+
+def election_archive(conn):
+    create_table(conn, table('election_archive',
+        Column('election_id', BigInteger, primary_key=True,
+            autoincrement=False),
+        Column('bundle_path', Unicode(1024)),
+        Column('bundle_hash', Unicode(255)),
+        Column('bundle_size', BigInteger),
+        Column('archived_at', DateTime)
+    ))
+    create_table(conn, table('archived_election',
+        Column('id', BigInteger, primary_key=True, autoincrement=False),
+        Column('num_parties', Integer),
+        Column('threshold_parties', Integer),
+        Column('created_at', DateTime),
+        Column('last_updated_at', DateTime),
+        Column('title', Unicode(255)),
+        Column('description', UnicodeText),
+        Column('questions', UnicodeText),
+        Column('start_date', DateTime),
+        Column('end_date', DateTime),
+        Column('status', Unicode(128)),
+        Column('callback_url', Unicode(1024))
+    ))
+    create_table(conn, table('archived_session',
+        Column('id', Unicode(255), primary_key=True, autoincrement=False),
+        Column('election_id', Integer),
+        Column('question_number', Integer),
+        Column('status', Unicode(128)),
+        Column('public_key', UnicodeText),
+        Index('ix_archived_session_election_id', 'election_id')
+    ))
+    create_table(conn, table('archived_authority',
+        Column('id', Integer, primary_key=True, autoincrement=False),
+        Column('name', Unicode(255)),
+        Column('ssl_cert', UnicodeText),
+        Column('fingerprint', Unicode(64)),
+        Column('orchestra_url', Unicode(1024)),
+        Column('election_id', Integer),
+        Column('created_at', DateTime),
+        Column('last_updated_at', DateTime),
+        Index('ix_archived_authority_election_id', 'election_id')
+    ))
+    create_table(conn, table('archived_ballot',
+        Column('session_id', Unicode(255), primary_key=True,
+            autoincrement=False),
+        Column('ballot_hash', Unicode(45), primary_key=True,
+            autoincrement=False)
+    ))
+    create_table(conn, table('archived_tally_checkpoint',
+        Column('election_id', BigInteger, primary_key=True,
+            autoincrement=False),
+        Column('session_id', Unicode(255), primary_key=True,
+            autoincrement=False),
+        Column('phase', Unicode(20), primary_key=True, autoincrement=False),
+        Column('input_hash', Unicode(255)),
+        Column('output_hash', Unicode(255)),
+        Column('created_at', DateTime)
+    ))
+
+
+def election_status_index(conn):
+    create_index(conn, 'ix_election_status_id', 'election', ['status', 'id'])
+
+
+def published_tally_checkpoints(conn):
+    '''
+    Records as published, at the date of their file, the tallies published
+    before the published checkpoint existed, so that they can be archived
+    '''
+    election = table('election',
+        Column('id', BigInteger, primary_key=True)
+    )
+    tally_checkpoint = table('tally_checkpoint',
+        Column('election_id', BigInteger, primary_key=True),
+        Column('session_id', Unicode(255), primary_key=True),
+        Column('phase', Unicode(20), primary_key=True),
+        Column('input_hash', Unicode(255)),
+        Column('output_hash', Unicode(255)),
+        Column('created_at', DateTime)
+    )
+    published = select([tally_checkpoint.c.election_id])\
+        .where(tally_checkpoint.c.session_id == '')\
+        .where(tally_checkpoint.c.phase == 'published')
+    rows = conn.execute(select([election.c.id])
+        .where(~election.c.id.in_(published))).fetchall()
+
+    public_data_path = app.config.get('PUBLIC_DATA_PATH', '')
+    for election_id, in rows:
+        tally_path = os.path.join(public_data_path, str(election_id),
+            'tally.tar.gz')
+        if not os.path.isfile(tally_path):
+            continue
+        conn.execute(tally_checkpoint.insert().values(
+            election_id=election_id,
+            session_id='',
+            phase='published',
+            created_at=datetime.utcfromtimestamp(os.path.getmtime(tally_path))
+        ))
+
+
+def election_archive_state(conn):
+    add_column(conn, 'election_archive', Column('state', Unicode(20)))
+    election_archive = table('election_archive',
+        Column('election_id', BigInteger, primary_key=True,
+            autoincrement=False),
+        Column('state', Unicode(20))
+    )
+    conn.execute(election_archive.update()
+        .where(election_archive.c.state == None)
+        .values(state='archived'))
+
+
+def tally_checkpoint_output_stat(conn):
+    for table_name in ['tally_checkpoint', 'archived_tally_checkpoint']:
+        add_column(conn, table_name, Column('output_size', BigInteger))
+        add_column(conn, table_name, Column('output_mtime', Float))
+
+
+MIGRATIONS = [
+    (1, 'queue_scheduling', queue_scheduling),
+    (2, 'queue_leases', queue_leases),
+    (3, 'queue_dedup', queue_dedup),
+    (4, 'metrics_tables', metrics_tables),
+    (5, 'tally_checkpoints', tally_checkpoints),
+    (6, 'authority_fingerprint', authority_fingerprint),
+    (7, 'lookup_indexes', lookup_indexes),
+    (8, 'election_archive', election_archive),
+    (9, 'election_status_index', election_status_index),
+    (10, 'published_tally_checkpoints', published_tally_checkpoints),
+    (11, 'election_archive_state', election_archive_state),
+    (12, 'tally_checkpoint_output_stat', tally_checkpoint_output_stat),
+]
@@ -13,6 +13,7 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.types import TypeDecorator, VARCHAR
 
 from frestq.app import db
+from utils import cert_fingerprint
 
 class Election(db.Model):
     '''
@@ -45,6 +46,11 @@ class Election(db.Model):
 
     callback_url = db.Column(db.Unicode(1024))
 
+    __table_args__ = (
+        # pages of elections filtered by status, see election_status
+        db.Index('ix_election_status_id', 'status', 'id'),
+    )
+
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -90,6 +96,11 @@ class Session(db.Model):
 
     public_key = db.Column(db.UnicodeText)
 
+    __table_args__ = (
+        db.Index('ix_session_election_question',
+            'election_id', 'question_number'),
+    )
+
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -121,6 +132,9 @@ class Authority(db.Model):
 
     ssl_cert = db.Column(db.UnicodeText)
 
+    # sha256 of the DER certificate, see utils.cert_fingerprint
+    fingerprint = db.Column(db.Unicode(64))
+
     orchestra_url = db.Column(db.Unicode(1024))
 
     election_id = db.Column(db.Integer, db.ForeignKey('election.id'))
@@ -132,9 +146,16 @@ class Authority(db.Model):
 
     last_updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_authority_election_fingerprint',
+            'election_id', 'fingerprint'),
+    )
+
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
+        if self.fingerprint is None:
+            self.fingerprint = cert_fingerprint(self.ssl_cert)
 
     def __repr__(self):
         return '<Authority %r>' % self.name
@@ -183,3 +204,167 @@ class QueryQueue(db.Model):
     data = db.Column(db.UnicodeText)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     doing = db.Column(db.Boolean, default=False)
+
+    # lane of the job: jobs of the same election are executed one at a time
+    election_id = db.Column(db.BigInteger)
+
+    # priority class of the job, see taskqueue.DEFAULT_PRIORITY_CLASSES
+    priority = db.Column(db.Unicode(20))
+
+    # jobs are started in rank order, see taskqueue.get_job_rank
+    rank = db.Column(db.Float)
+
+    # process running the job, which must renew its lease periodically or
+    # else the job is given to another worker, see taskqueue.renew_leases
+    worker_id = db.Column(db.Unicode(255))
+
+    lease_expires_at = db.Column(db.DateTime)
+
+    # number of times the job has been started
+    attempts = db.Column(db.Integer, default=0)
+
+    # identifies the request, so that a duplicated one is coalesced with this
+    # job instead of queued again, see taskqueue.get_dedup_key
+    dedup_key = db.Column(db.Unicode(255), index=True, unique=True)
+
+    # JSON list with the callback urls of the duplicated requests attached to
+    # this job, which are also notified when it finishes
+    extra_callback_urls = db.Column(db.UnicodeText)
+
+    __table_args__ = (
+        # pending and running jobs, in rank order
+        db.Index('ix_query_queue_doing_rank', 'doing', 'rank', 'id'),
+        # jobs of an election lane, see taskqueue.has_older_pending_job
+        db.Index('ix_query_queue_election_doing', 'election_id', 'doing', 'id'),
+    )
+
+
+class JobMetric(db.Model):
+    '''
+    Timing and outcome of a queued job, kept after the job leaves the queue
+    for capacity planning (see metrics.get_queue_metrics)
+    '''
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    # id of the job in QueryQueue
+    job_id = db.Column(db.Integer, index=True)
+
+    task = db.Column(db.Unicode(20))
+
+    election_id = db.Column(db.BigInteger)
+
+    priority = db.Column(db.Unicode(20))
+
+    queued_at = db.Column(db.DateTime, index=True)
+
+    started_at = db.Column(db.DateTime)
+
+    ended_at = db.Column(db.DateTime)
+
+    # success, error, launch_error or dropped, None while not finished
+    outcome = db.Column(db.Unicode(20))
+
+
+class PhaseMetric(db.Model):
+    '''
+    Timing and outcome of the execution of a frestq action handler in this
+    node (see metrics.timed_phase)
+    '''
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    action = db.Column(db.Unicode(64))
+
+    election_id = db.Column(db.BigInteger)
+
+    started_at = db.Column(db.DateTime, index=True)
+
+    ended_at = db.Column(db.DateTime)
+
+    # success or error
+    outcome = db.Column(db.Unicode(20))
+
+
+class TallyCheckpoint(db.Model):
+    '''
+    Records that a phase of the tally of an election session has been
+    completed, with the hashes of its input and its output, so that it can be
+    skipped when the tally is resumed (see tally_checkpoints)
+    '''
+    election_id = db.Column(db.BigInteger, primary_key=True)
+
+    # empty for the phases of the whole election
+    session_id = db.Column(db.Unicode(255), primary_key=True)
+
+    phase = db.Column(db.Unicode(20), primary_key=True)
+
+    input_hash = db.Column(db.Unicode(255))
+
+    output_hash = db.Column(db.Unicode(255))
+
+    # size and mtime of the output when the checkpoint was saved, so that its
+    # changes can be detected without hashing it again
+    output_size = db.Column(db.BigInteger)
+
+    output_mtime = db.Column(db.Float)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SchemaVersion(db.Model):
+    '''
+    Migrations applied to the database, see migrations.migrate
+    '''
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    name = db.Column(db.Unicode(255))
+
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ElectionArchive(db.Model):
+    '''
+    Election whose rows were moved to the archive tables and whose private
+    data was packed into a cold storage bundle (see archive.archive_election)
+    '''
+    election_id = db.Column(db.BigInteger, primary_key=True,
+        autoincrement=False)
+
+    bundle_path = db.Column(db.Unicode(1024))
+
+    # sha256 of the bundle, checked before restoring it
+    bundle_hash = db.Column(db.Unicode(255))
+
+    bundle_size = db.Column(db.BigInteger)
+
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # archiving, archived or restoring, so that an interrupted archival or
+    # restore can be resumed
+    state = db.Column(db.Unicode(20))
+
+
+def archive_table(model, election_column=None):
+    '''
+    Returns the archive table of a model, with the same columns but without
+    foreign keys, and indexed by its election column if given
+    '''
+    table = model.__table__
+    name = 'archived_' + table.name
+    columns = [
+        db.Column(column.name, column.type, primary_key=column.primary_key,
+            autoincrement=False)
+        for column in table.columns
+    ]
+    indexes = []
+    if election_column is not None:
+        indexes.append(db.Index('ix_%s_%s' % (name, election_column),
+            election_column))
+    return db.Table(name, db.metadata, *(columns + indexes))
+
+
+archived_election = archive_table(Election)
+archived_session = archive_table(Session, 'election_id')
+archived_authority = archive_table(Authority, 'election_id')
+# indexed by their primary keys, which start by session_id and election_id
+archived_ballot = archive_table(Ballot)
+archived_tally_checkpoint = archive_table(TallyCheckpoint)
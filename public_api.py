@@ -5,13 +5,11 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 #
-import pickle
-import base64
 import json
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from flask import Blueprint, request, make_response, abort
+from flask import Blueprint, Response, request, make_response, abort
 
 from frestq.utils import loads, dumps
 from frestq.tasks import SimpleTask, TaskError
@@ -20,9 +18,12 @@ from frestq.app import app, db
 from models import Election, Authority, QueryQueue
 from create_election.performer_jobs import check_election_data
 import keys_management
+from metrics import get_queue_metrics
+from election_status import get_cached, list_elections, get_election_status
 
 
-from taskqueue import queue_task, apply_task, dequeue_task
+from taskqueue import (queue_task, queue_elections, notify_queue, list_queue,
+    set_job_priority, move_job_to_front, get_priority_classes)
 
 public_api = Blueprint('public_api', __name__)
 
@@ -34,14 +35,124 @@ def error(status, message=""):
     return make_response(data, status)
 
 
+def get_int(data, key):
+    '''
+    Returns data[key] if data is a dict and it's an int, or None otherwise
+    '''
+    if not isinstance(data, dict):
+        return None
+    value = data.get(key, None)
+    if not isinstance(value, int) or isinstance(value, bool):
+        return None
+    return value
+
+
 @public_api.route('/dequeue', methods=['GET'])
 def dequeue():
+    '''
+    Wakes up the queue dispatcher. Not needed anymore, as it's notified when
+    jobs are queued or finished, but kept for compatibility.
+    '''
+    notify_queue()
+    return make_response(dumps(dict(status="ok")), 202)
+
+
+@public_api.route('/queue', methods=['GET'])
+def get_queue():
+    '''
+    GET /queue
+
+    Lists the running jobs and then the pending ones, in the order in which
+    they will be considered for execution.
+    '''
+    return make_response(dumps(dict(jobs=list_queue())), 200)
+
+
+@public_api.route('/metrics/queue', methods=['GET'])
+def get_metrics_queue():
+    '''
+    GET /metrics/queue?hours=24
+
+    Returns the current queue depth and, for the jobs queued in the last
+    hours (by default QUEUE_METRICS_WINDOW_HOURS), the outcomes and the wait
+    and run time histograms per type of task, and the duration of each phase
+    executed in this node. Times are in seconds, and the histograms are
+    cumulative:
+
+    {
+        "since": "2021-01-01T00:00:00",
+        "depth": {"pending": 3, "running": 1},
+        "tasks": {
+            "tally": {
+                "depth": {"pending": 3, "running": 1},
+                "outcomes": {"success": 10, "error": 1, "unfinished": 4},
+                "wait_time": {
+                    "count": 11,
+                    "mean": 42.5,
+                    "max": 320.0,
+                    "histogram": [{"le": 1, "count": 0}, .., {"le": "+Inf", "count": 11}]
+                },
+                "run_time": {..}
+            }
+        },
+        "phases": {
+            "perform_tally": {
+                "outcomes": {"success": 11},
+                "duration": {..}
+            }
+        }
+    }
+    '''
+    hours = request.args.get('hours', None)
+    if hours is None:
+        hours = app.config.get('QUEUE_METRICS_WINDOW_HOURS', 24*7)
     try:
-        dequeue_task()
-    except Exception as e:
-        return make_response(dumps(dict(status=e.message)), 202)
+        hours = float(hours)
+    except ValueError:
+        return error(400, "invalid hours")
+    if hours <= 0:
+        return error(400, "invalid hours")
 
-    return make_response(dumps(dict(status="ok")), 202)
+    since = datetime.utcnow() - timedelta(hours=hours)
+    return make_response(dumps(get_queue_metrics(since)), 200)
+
+
+@public_api.route('/queue/<int:queue_id>', methods=['POST'])
+def reorder_queue(queue_id):
+    '''
+    POST /queue/<queue_id>
+
+    Changes the position of a pending job in the queue, either changing its
+    priority class or moving it to the front of the queue:
+
+    {"priority": "urgent"}
+    {"front": true}
+    '''
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return error(400, "invalid json")
+
+    job = db.session.query(QueryQueue)\
+        .filter(QueryQueue.id == queue_id)\
+        .first()
+    if job is None:
+        return error(404, "job not found")
+    if job.doing:
+        return error(400, "job already running")
+
+    if 'priority' in data:
+        if data['priority'] not in get_priority_classes():
+            return error(400, "invalid priority class")
+        set_job_priority(job, data['priority'])
+    if data.get('front', False):
+        move_job_to_front(job)
+    db.session.commit()
+
+    return make_response(dumps(dict(
+        queue_id=job.id,
+        priority=job.priority,
+        rank=job.rank
+    )), 200)
 
 
 @public_api.route('/election', methods=['POST'])
@@ -128,6 +239,10 @@ def post_election():
     {
         "task_id": "ba83ee09-aa83-1901-bb11-e645b52fc558",
     }
+
+    If an election with the same id is already queued, created or archived,
+    the response has status 409 Conflict.
+
     When the election finally gets processed, the callback_url is called with a
     POST containing the protInfo.xml file generated jointly by each
     authority, following this example response:
@@ -165,12 +280,183 @@ def post_election():
     '''
 
     data = request.get_json(force=True, silent=True)
-    d = base64.b64encode(pickle.dumps(data)).decode('utf-8')
-    queueid = queue_task(task='election', data=d)
+    priority = request.args.get('priority', None)
+    if priority is not None and priority not in get_priority_classes():
+        return error(400, "invalid priority class")
+    try:
+        queueid = queue_task(task='election', data=data,
+                             election_id=get_int(data, 'id'),
+                             priority=priority)
+    except TaskError as e:
+        return error(409, str(e))
 
     return make_response(dumps(dict(queue_id=queueid)), 202)
 
 
+def get_date_arg(name):
+    '''
+    Returns the request argument name parsed as an ISO 8601 date, None if
+    it's missing. Raises ValueError if it's invalid.
+    '''
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    return datetime.fromisoformat(value)
+
+
+@public_api.route('/elections', methods=['GET'])
+def get_elections():
+    '''
+    GET /elections?status=created&created_after=2021-01-01&after_id=100&limit=50
+
+    Lists the elections in id order, one page at a time. All the parameters
+    are optional:
+
+    - status: comma separated list of statuses
+    - created_after, created_before: ISO 8601 dates (UTC)
+    - after_id: id of the last election of the previous page
+    - limit: maximum number of elections, by default 50 and at most
+      ELECTION_STATUS_MAX_LIMIT
+    - full: "true" to include the authorities of each election
+
+    Responses are cached during ELECTION_STATUS_CACHE_SECONDS. Example:
+
+    {
+        "elections": [
+            {
+                "id": 101,
+                "title": "..",
+                "status": "created",
+                ..
+            }
+        ],
+        "next_after_id": 150
+    }
+
+    next_after_id is null on the last page.
+    '''
+    try:
+        created_after = get_date_arg('created_after')
+        created_before = get_date_arg('created_before')
+    except ValueError:
+        return error(400, "invalid date")
+
+    try:
+        after_id = request.args.get('after_id', None)
+        if after_id is not None:
+            after_id = int(after_id)
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return error(400, "invalid after_id or limit")
+    max_limit = app.config.get('ELECTION_STATUS_MAX_LIMIT', 500)
+    if limit < 1 or limit > max_limit:
+        return error(400, "limit must be between 1 and %d" % max_limit)
+
+    status = request.args.get('status', None)
+    if status is not None:
+        status = tuple(sorted(set(status.split(','))))
+    full = request.args.get('full', 'false') == 'true'
+
+    def build():
+        elections, next_after_id = list_elections(status, created_after,
+            created_before, after_id, limit, full)
+        return dumps(dict(elections=elections, next_after_id=next_after_id))
+
+    key = ('elections', status, created_after, created_before, after_id,
+        limit, full)
+    return make_response(get_cached(key, build), 200)
+
+
+@public_api.route('/elections/<int:election_id>', methods=['GET'])
+def get_election(election_id):
+    '''
+    GET /elections/<election_id>
+
+    Returns an election with its authorities and the status and public key
+    of its sessions, one per question, in question order. Responses are
+    cached during ELECTION_STATUS_CACHE_SECONDS.
+    '''
+    def build():
+        election = get_election_status(election_id)
+        return dumps(election) if election is not None else None
+
+    body = get_cached(('election', election_id), build)
+    if body is None:
+        return error(404, "election not found")
+    return make_response(body, 200)
+
+
+@public_api.route('/elections', methods=['POST'])
+def post_elections():
+    '''
+    POST /elections
+
+    Creates many elections at once. The body is a list of elections, each of
+    them with the same format as in POST /election:
+
+    {
+        "elections": [
+            {"id": 1110, "title": "..", ..},
+            {"id": 1111, "title": "..", ..}
+        ]
+    }
+
+    All the elections are checked before creating any of them. If any is
+    invalid, none is created and the response is a 400 with the index of the
+    first invalid election:
+
+    {
+        "index": 1,
+        "message": "invalid title parameter"
+    }
+
+    If any of the elections is already queued, none is and the response has
+    status 409 Conflict.
+
+    Otherwise, the elections are created and queued in a single transaction,
+    and the response has status 202 Accepted with the queue ids in the same
+    order:
+
+    {
+        "queue_ids": [31, 32]
+    }
+
+    Each election is then processed as with POST /election.
+    '''
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('elections'), list)\
+            or not data['elections']:
+        return error(400, "invalid json")
+    elections = data['elections']
+
+    priority = request.args.get('priority', None)
+    if priority is not None and priority not in get_priority_classes():
+        return error(400, "invalid priority class")
+
+    max_elections = app.config.get('MAX_ELECTIONS_PER_BULK_REQUEST', 1000)
+    if len(elections) > max_elections:
+        return error(400, "too many elections")
+
+    seen_ids = set()
+    for index, election_data in enumerate(elections):
+        try:
+            if not isinstance(election_data, dict):
+                raise TaskError(dict(reason="invalid election"))
+            check_election_data(election_data, True)
+            if election_data['id'] in seen_ids:
+                raise TaskError(dict(reason="duplicated id %s" %
+                    election_data['id']))
+            seen_ids.add(election_data['id'])
+        except TaskError as e:
+            return make_response(dumps(dict(index=index, message=str(e))), 400)
+
+    try:
+        queue_ids = queue_elections(elections, priority)
+    except TaskError as e:
+        return error(409, str(e))
+    return make_response(dumps(dict(queue_ids=queue_ids)), 202)
+
+
 @public_api.route('/tally', methods=['POST'])
 def post_tally():
     '''
@@ -185,9 +471,15 @@ def post_tally():
         "election_id": 111,
         "callback_url": "https://127.0.0.1:5000/public_api/receive_tally",
         "votes_url": "https://127.0.0.1:5000/public_data/vota4/encrypted_ciphertexts",
-        "votes_hash": "ni:///sha-256;f4OxZX_x_FO5LcGBSKHWXfwtSx-j1ncoSt3SABJtkGk"
+        "votes_hash": "ni:///sha-256;f4OxZX_x_FO5LcGBSKHWXfwtSx-j1ncoSt3SABJtkGk",
+        "resume": true
     }
 
+    The optional "resume" parameter, true by default, lets the authorities
+    skip the phases of the tally (download, conversion, mixing, verification
+    and publication) they already completed for the same votes in a previous
+    attempt. Set it to false to redo the whole tally.
+
     On success, response is empty with status 202 Accepted and returns something
     like:
 
@@ -195,6 +487,12 @@ def post_tally():
         "task_id": "ba83ee09-aa83-1901-bb11-e645b52fc558",
     }
 
+    A tally with the same election_id and votes_hash as one already queued or
+    running is not queued again: the request is attached to that job, whose
+    id is returned, and its callback_url is also called when it finishes. The
+    tally of an archived election is rejected with status 409 Conflict until
+    the election is restored (see --restore-election).
+
     When the election finally gets processed, the callback_url is called with POST
     similar to the following example:
 
@@ -227,8 +525,15 @@ def post_tally():
 
     # first of all, parse input data
     data = request.get_json(force=True, silent=True)
-    d = base64.b64encode(pickle.dumps(data)).decode('utf-8')
-    queueid = queue_task(task='tally', data=d)
+    priority = request.args.get('priority', None)
+    if priority is not None and priority not in get_priority_classes():
+        return error(400, "invalid priority class")
+    try:
+        queueid = queue_task(task='tally', data=data,
+                             election_id=get_int(data, 'election_id'),
+                             priority=priority)
+    except TaskError as e:
+        return error(409, str(e))
     return make_response(dumps(dict(queue_id=queueid)), 202)
 
 @public_api.route('/receive_election', methods=['POST'])
@@ -263,6 +568,10 @@ def check_state():
 def download_private_share():
     '''
     Download private share of the keys
+
+    The tar.gz with the keys is streamed in base64, or as is if the request
+    has "format": "binary". Its sha256 is sent in hex in the X-Archive-SHA256
+    header, and also in the Digest header for binary responses.
     '''
     print("ATTENTION received download-private-share: ")
 
@@ -272,9 +581,13 @@ def download_private_share():
     if not isinstance(election_id, str):
         make_response("election id missing", 400)
     
-    result, code = keys_management.download_private_share(election_id)
+    binary = req.get('format', 'base64') == 'binary'
+    result, code, headers = keys_management.download_private_share(
+        election_id, binary)
+    if code != 200:
+        return make_response(result, code)
 
-    return make_response(result, code)
+    return Response(result, status=code, headers=headers)
 
 @public_api.route('/check_private_share', methods=['POST'])
 def check_private_share():
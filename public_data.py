@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+import os
+import re
+
+from flask import Blueprint, send_file, abort
+from werkzeug.utils import safe_join
+
+from frestq.app import app
+
+public_data = Blueprint('public_data', __name__)
+
+# content-addressed files, published as <election_id>/objects/<sha256>. They
+# never change, so clients and proxies can cache them forever
+CONTENT_ADDRESSED_RE = re.compile("^[0-9]+/objects/(?P<hash>[0-9a-f]{64})$")
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def get_strong_etag(file_path, rel_path):
+    '''
+    Returns the strong ETag of a public file, derived from its sha256 so that
+    it's the same in every authority: the name of a content-addressed file,
+    or the contents of the <file>.sha256 published next to it, like the one of
+    tally.tar.gz. Returns None if there's no such hash or if it's older than
+    the file, which happens while the file is being rewritten.
+    '''
+    match = CONTENT_ADDRESSED_RE.match(rel_path)
+    if match:
+        return match.group('hash')
+
+    hash_path = file_path + '.sha256'
+    if not os.path.isfile(hash_path) or\
+            os.path.getmtime(hash_path) < os.path.getmtime(file_path):
+        return None
+
+    with open(hash_path, 'r') as hash_file:
+        file_hash = hash_file.read().strip()
+    if not re.match("^[a-zA-Z0-9_=-]+$", file_hash):
+        return None
+    return file_hash
+
+@public_data.route('/<path:rel_path>', methods=['GET'])
+def get_public_file(rel_path):
+    '''
+    GET /public_data/<path>
+
+    Serves the files in PUBLIC_DATA_PATH. Supports byte-range requests and
+    conditional requests with the ETag. The file is sent with the
+    wsgi.file_wrapper of the server (sendfile in uwsgi) or, if USE_X_SENDFILE
+    is set, by the frontend web server.
+    '''
+    pubdata_path = app.config.get('PUBLIC_DATA_PATH', '')
+    file_path = safe_join(pubdata_path, rel_path)
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+
+    etag = get_strong_etag(file_path, rel_path)
+    immutable = CONTENT_ADDRESSED_RE.match(rel_path) is not None
+    response = send_file(
+        file_path,
+        mimetype='application/octet-stream',
+        conditional=True,
+        etag=etag if etag is not None else True
+    )
+
+    if immutable:
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        # files like tally.tar.gz can change with a new tally, so clients must
+        # revalidate them with the ETag
+        response.headers['Cache-Control'] = 'no-cache'
+
+    return response
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+import json
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from frestq.app import app
+from models import Election
+
+class CachedQuestions(object):
+    '''
+    Parsed questions of an election and their canonical serialization, the
+    one written to questions_json in the tally
+    '''
+    def __init__(self, raw):
+        self.raw = raw
+        self.parsed = json.loads(raw)
+        self._canonical = None
+
+    @property
+    def canonical(self):
+        if self._canonical is None:
+            self._canonical = json.dumps(self.parsed, ensure_ascii=False,
+                sort_keys=True, indent=4, separators=(',', ': '))
+        return self._canonical
+
+
+# CachedQuestions by election id, least recently used first
+questions_cache = OrderedDict()
+questions_cache_lock = threading.Lock()
+
+def get_cached_questions(election):
+    '''
+    Returns the CachedQuestions of an election, given either the model or an
+    election snapshot. The entry is also checked against the questions of
+    the given election, in case they were changed by another process.
+    '''
+    with questions_cache_lock:
+        cached = questions_cache.get(election.id, None)
+        if cached is not None and cached.raw == election.questions:
+            questions_cache.move_to_end(election.id)
+            return cached
+
+    cached = CachedQuestions(election.questions)
+    with questions_cache_lock:
+        questions_cache[election.id] = cached
+        max_size = app.config.get('QUESTIONS_CACHE_SIZE', 1000)
+        while len(questions_cache) > max_size:
+            questions_cache.popitem(last=False)
+    return cached
+
+
+def get_questions(election):
+    '''
+    Returns the parsed questions of an election. They are shared, so they
+    must not be modified.
+    '''
+    return get_cached_questions(election).parsed
+
+
+def get_canonical_questions(election):
+    '''
+    Returns the questions of an election serialized with sorted keys and
+    indentation, as published in the tally
+    '''
+    return get_cached_questions(election).canonical
+
+
+def invalidate_questions(election_id):
+    with questions_cache_lock:
+        questions_cache.pop(election_id, None)
+
+
+@event.listens_for(Election.questions, 'set')
+def on_questions_set(target, value, oldvalue, initiator):
+    if target.id is not None:
+        invalidate_questions(target.id)
+
+
+@event.listens_for(Election, 'after_delete')
+def on_election_deleted(mapper, connection, target):
+    invalidate_questions(target.id)
@@ -35,6 +35,62 @@ def hash_file(file_path):
     f.close()
     return urlsafe_b64encode(hash.digest()).decode('utf-8')
 
+class HashingWriter(object):
+    '''
+    Write-only file object that forwards everything written to it to the
+    wrapped file object while computing its sha256, so that the hash of a
+    file can be obtained while the file is being produced instead of reading
+    it back afterwards.
+
+    If fileobj is None, written data is only hashed.
+    '''
+    def __init__(self, fileobj=None):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        if self.fileobj is not None:
+            self.fileobj.flush()
+
+    def hash_digest(self):
+        '''
+        Returns the hash of the written data in the same format as hash_file
+        '''
+        return urlsafe_b64encode(self.hash.digest()).decode('utf-8')
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+class HashingReader(object):
+    '''
+    Read-only file object that computes the sha256 of everything read from
+    the wrapped file object.
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print("usage: %s <file-path> to obtain the sha256sum" % sys.argv[0])
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+#
+# SPDX-FileCopyrightText: 2013-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+import os
+from datetime import datetime
+
+from frestq.app import db
+from models import TallyCheckpoint
+from sha256 import hash_file, hash_data
+
+# phases of the tally of each session, in order, with the file they produce
+# inside the session private path:
+# - ingested: votes downloaded and split into the ciphertexts of the session
+# - converted: ciphertexts converted to the mixnet raw format
+# - mixed: ciphertexts mixed and decrypted by the mixnet
+# - verified: proofs verified and plaintexts converted to json
+SESSION_PHASES = [
+    ('ingested', 'ciphertexts_json'),
+    ('converted', 'ciphertexts_raw'),
+    ('mixed', 'plaintexts_raw'),
+    ('verified', 'plaintexts_json'),
+]
+
+# phase of the whole election, producing the published tally.tar.gz
+PUBLISHED_PHASE = 'published'
+
+# files that must also exist for a mixed session to be considered complete
+MIXED_EXTRA_PATHS = [os.path.join('dir', 'roProof')]
+
+def get_checkpoint(election_id, session_id, phase):
+    return db.session.query(TallyCheckpoint)\
+        .filter(TallyCheckpoint.election_id == election_id)\
+        .filter(TallyCheckpoint.session_id == session_id)\
+        .filter(TallyCheckpoint.phase == phase)\
+        .first()
+
+
+def is_checkpoint_valid(checkpoint, input_hash, output_path,
+        verify_hash=False):
+    '''
+    A checkpoint is valid if its phase was completed with the given input and
+    its output is still there, unmodified. The output is considered
+    unmodified if its size and mtime are the recorded ones, and if
+    verify_hash is True, its hash is also checked, reading it whole.
+    '''
+    if checkpoint is None or checkpoint.output_hash is None or\
+            (input_hash is not None and checkpoint.input_hash != input_hash) or\
+            not os.path.isfile(output_path):
+        return False
+    stat = os.stat(output_path)
+    if stat.st_size != checkpoint.output_size or\
+            stat.st_mtime != checkpoint.output_mtime:
+        return False
+    return not verify_hash or hash_file(output_path) == checkpoint.output_hash
+
+
+def get_done_session_phases(election_id, session_id, session_privpath,
+        votes_hash=None, verify_hash=False):
+    '''
+    Returns the list of the phases of the tally of a session that are
+    completed, in order. Each phase is only completed if its input is the
+    output of the previous completed phase, and the first one if its input
+    are the given votes. If votes_hash is None, the votes of the last
+    ingestion are assumed.
+
+    The outputs are only hashed again if verify_hash is True, which is done
+    when a tally is resumed, see is_checkpoint_valid.
+    '''
+    done = []
+    input_hash = votes_hash
+    for phase, output_name in SESSION_PHASES:
+        checkpoint = get_checkpoint(election_id, session_id, phase)
+        output_path = os.path.join(session_privpath, output_name)
+        if not is_checkpoint_valid(checkpoint, input_hash, output_path,
+                verify_hash):
+            break
+        if phase == 'mixed' and not all([
+                os.path.exists(os.path.join(session_privpath, path))
+                for path in MIXED_EXTRA_PATHS]):
+            break
+        done.append(phase)
+        input_hash = checkpoint.output_hash
+    return done
+
+
+def mark_session_phase_done(election_id, session_id, session_privpath, phase,
+        votes_hash=None, output_hash=None):
+    '''
+    Records that a phase of the tally of a session has been completed. The
+    input of the ingested phase are the given votes, and the input of the
+    other phases is the output of the previous one. The hash of the output
+    is computed unless given.
+    '''
+    phases = [name for name, _ in SESSION_PHASES]
+    output_name = dict(SESSION_PHASES)[phase]
+    index = phases.index(phase)
+    if index == 0:
+        input_hash = votes_hash
+    else:
+        previous = get_checkpoint(election_id, session_id, phases[index - 1])
+        input_hash = previous.output_hash if previous is not None else None
+
+    save_checkpoint(election_id, session_id, phase, input_hash,
+        os.path.join(session_privpath, output_name), output_hash)
+
+
+def get_publish_input_hash(election_id, session_ids, layout):
+    '''
+    The input of the published phase are the verified plaintexts of all the
+    sessions and the layout of the tarball
+    '''
+    hashes = []
+    for session_id in session_ids:
+        checkpoint = get_checkpoint(election_id, session_id, 'verified')
+        if checkpoint is None:
+            return None
+        hashes.append(checkpoint.output_hash)
+    return hash_data("%s/%s" % (layout, "/".join(hashes)))
+
+
+def is_published(election_id, session_ids, layout, tally_path):
+    '''
+    Returns True if the tally was already published from the current
+    verified plaintexts of all the sessions
+    '''
+    input_hash = get_publish_input_hash(election_id, session_ids, layout)
+    if input_hash is None:
+        return False
+    checkpoint = get_checkpoint(election_id, '', PUBLISHED_PHASE)
+    return is_checkpoint_valid(checkpoint, input_hash, tally_path)
+
+
+def mark_published(election_id, session_ids, layout, tally_path,
+        tally_hash=None):
+    input_hash = get_publish_input_hash(election_id, session_ids, layout)
+    save_checkpoint(election_id, '', PUBLISHED_PHASE, input_hash, tally_path,
+        tally_hash)
+
+
+def unmark_published(election_id):
+    clear_checkpoints(election_id, '', [PUBLISHED_PHASE])
+
+
+def save_checkpoint(election_id, session_id, phase, input_hash, output_path,
+        output_hash=None):
+    '''
+    Saves a checkpoint with the hash, size and mtime of its output. The hash
+    is only computed if it's not given, as it means reading the whole output.
+    '''
+    checkpoint = get_checkpoint(election_id, session_id, phase)
+    if checkpoint is None:
+        checkpoint = TallyCheckpoint(
+            election_id=election_id,
+            session_id=session_id,
+            phase=phase
+        )
+        db.session.add(checkpoint)
+    if output_hash is None:
+        output_hash = hash_file(output_path)
+    stat = os.stat(output_path)
+    checkpoint.input_hash = input_hash
+    checkpoint.output_hash = output_hash
+    checkpoint.output_size = stat.st_size
+    checkpoint.output_mtime = stat.st_mtime
+    checkpoint.created_at = datetime.utcnow()
+    db.session.commit()
+
+
+def clear_checkpoints(election_id, session_id=None, phases=None):
+    '''
+    Removes the checkpoints of an election, optionally only the ones of the
+    given session and phases
+    '''
+    query = db.session.query(TallyCheckpoint)\
+        .filter(TallyCheckpoint.election_id == election_id)
+    if session_id is not None:
+        query = query.filter(TallyCheckpoint.session_id == session_id)
+    if phases is not None:
+        if not phases:
+            return
+        query = query.filter(TallyCheckpoint.phase.in_(phases))
+    query.delete(synchronize_session=False)
+    db.session.commit()
@@ -17,24 +17,23 @@ from frestq.tasks import (SimpleTask, ParallelTask, SequentialTask,
 from frestq.action_handlers import TaskHandler, SynchronizedTaskHandler
 from frestq.app import app, db
 
-from models import Election, Authority, Session
+from models import Election, Authority
 from reject_adapter import RejectAdapter
 from utils import mkdir_recursive
 
-from taskqueue import end_task
+from taskqueue import end_task, get_extra_callback_urls
+from metrics import timed_phase
+from election_snapshot import load_election_snapshot
 
 @decorators.local_task
 @decorators.task(action="tally_election", queue="launch_task")
+@timed_phase("tally_election")
 class TallyElectionTask(TaskHandler):
     def execute(self):
         data = self.task.get_data()['input_data']
         election_id = data['election_id']
-        election = db.session.query(Election)\
-            .filter(Election.id == election_id).first()
-
-        session_ids = [s.id for s in db.session.query(Session).\
-                with_parent(election,"sessions").\
-                order_by(Session.question_number)]
+        election = load_election_snapshot(election_id)
+        session_ids = [session.id for session in election.sessions]
 
         # 1. let all authorities download the votes and review the requested
         # tally
@@ -49,6 +48,7 @@ class TallyElectionTask(TaskHandler):
                     'callback_url': data['callback_url'],
                     'votes_url': data['votes_url'],
                     'votes_hash': data['votes_hash'],
+                    'resume': data.get('resume', True),
                 },
                 receiver_ssl_cert=authority.ssl_cert
             )
@@ -57,23 +57,16 @@ class TallyElectionTask(TaskHandler):
 
         # 2. once all the authorities have reviewed and accepted the tallies
         # (one per question/session), launch mixnet to perform it
-        seq_task = SequentialTask()
-        self.task.add(seq_task)
-        for session_id in session_ids:
-            sync_task = SynchronizedTask()
-            seq_task.add(sync_task)
-            for authority in election.authorities:
-                auth_task = SimpleTask(
-                    receiver_url=authority.orchestra_url,
-                    action="perform_tally",
-                    queue="mixnet_queue",
-                    data={
-                        'election_id': data['election_id'],
-                        'session_id': session_id
-                    },
-                    receiver_ssl_cert=authority.ssl_cert
-                )
-                sync_task.add(auth_task)
+        mix_task = SimpleTask(
+            receiver_url=app.config.get('ROOT_URL', ''),
+            action="mix_tally",
+            queue="orchestra_director",
+            data={
+                'election_id': data['election_id'],
+                'session_ids': session_ids
+            }
+        )
+        self.task.add(mix_task)
 
         # once the mixing phase has been done, let all the authorities verify
         # the results and publish them
@@ -86,6 +79,7 @@ class TallyElectionTask(TaskHandler):
                 data={
                     'election_id': data['election_id'],
                     'session_ids': session_ids,
+                    'tally_layout': app.config.get('TALLY_LAYOUT', 'embedded'),
                 },
                 receiver_ssl_cert=authority.ssl_cert
             )
@@ -145,12 +139,78 @@ class TallyElectionTask(TaskHandler):
                 print("exception calling to callback_url:")
                 print(post_error)
                 raise post_error
+            finally:
+                # the duplicated requests are notified even if the callback
+                # of the original one failed
+                for extra_url in get_extra_callback_urls(election_id,
+                        input_data.get('job_id', None)):
+                    post_extra_callback(extra_url, fail_data)
         finally:
-            end_task()
+            input_data = self.task.get_data()['input_data']
+            end_task(
+                input_data['election_id'],
+                'error',
+                input_data.get('job_id', None)
+            )
+
+
+@decorators.task(action="mix_tally", queue="orchestra_director")
+@decorators.local_task
+@timed_phase("mix_tally")
+def mix_tally_task(task):
+    '''
+    Launches the joint mix of each session, one after the other, except for
+    the sessions that every authority reported as already mixed with these
+    votes in review_tally
+    '''
+    input_data = task.get_data()['input_data']
+    election_id = input_data['election_id']
+    session_ids = input_data['session_ids']
+    election = load_election_snapshot(election_id)
+
+    review_task = task.get_prev()
+    mixed_session_ids = set(session_ids)
+    for subtask in review_task.get_children():
+        output_data = subtask.get_data()['output_data']
+        if not isinstance(output_data, dict):
+            mixed_session_ids = set()
+            break
+        mixed_session_ids &= set(output_data.get('mixed_session_ids', []))
+
+    for session_id in session_ids:
+        if session_id in mixed_session_ids:
+            print("session %s already mixed by all the authorities, "
+                "skipping" % session_id)
+    session_ids = [
+        session_id
+        for session_id in session_ids
+        if session_id not in mixed_session_ids
+    ]
+    if not session_ids:
+        return
+
+    seq_task = SequentialTask()
+    task.add(seq_task)
+    for session_id in session_ids:
+        sync_task = SynchronizedTask()
+        seq_task.add(sync_task)
+        for authority in election.authorities:
+            auth_task = SimpleTask(
+                receiver_url=authority.orchestra_url,
+                action="perform_tally",
+                queue="mixnet_queue",
+                data={
+                    'election_id': election_id,
+                    'session_id': session_id
+                },
+                receiver_ssl_cert=authority.ssl_cert
+            )
+            sync_task.add(auth_task)
 
 
 @decorators.local_task
 @decorators.task(action="return_tally", queue="orchestra_director")
+@timed_phase("return_tally")
 def return_election(task):
     input_data = task.get_parent().get_data()['input_data']
     election_id = input_data['election_id']
@@ -196,4 +256,34 @@ def return_election(task):
         cert=(ssl_cert_path, ssl_key_path)
     )
     print(r.text)
-    end_task()
+
+    # also notify the duplicated requests attached to this tally
+    job_id = input_data.get('job_id', None)
+    for extra_url in get_extra_callback_urls(election_id, job_id):
+        post_extra_callback(extra_url, ret_data)
+    end_task(election_id, job_id=job_id)
+
+
+def post_extra_callback(callback_url, data):
+    '''
+    Posts the result of the tally to the callback_url of a duplicated request.
+    Errors are only printed, as the tally itself is already finished.
+    '''
+    session = requests.sessions.Session()
+    session.mount('http://', RejectAdapter())
+    ssl_calist_path = app.config.get('SSL_CALIST_PATH', '')
+    ssl_cert_path = app.config.get('SSL_CERT_PATH', '')
+    ssl_key_path = app.config.get('SSL_KEY_PATH', '')
+    try:
+        r = session.request(
+            'post',
+            callback_url,
+            data=dumps(data),
+            headers={'content-type': 'application/json'},
+            verify=ssl_calist_path,
+            cert=(ssl_cert_path, ssl_key_path)
+        )
+        print(r.text)
+    except Exception as e:
+        print("exception calling to callback_url %s:" % callback_url)
+        print(e)
@@ -8,7 +8,6 @@
 import os
 import csv
 import re
-import tarfile
 import codecs
 import hashlib
 import subprocess
@@ -18,22 +17,29 @@ import shutil
 import signal
 from datetime import datetime
 
+from sqlalchemy import select, and_
+
 from frestq.app import app, db
 from frestq import decorators
-from frestq.utils import dumps, loads
+from frestq.utils import dumps
 from frestq.tasks import SimpleTask, ParallelTask, ExternalTask, TaskError
-from frestq.protocol import certs_differ
 from frestq.action_handlers import TaskHandler
 
 from models import Election, Authority, Session, Ballot
 from reject_adapter import RejectAdapter
 from utils import *
+from metrics import timed_phase
+from authorities import is_election_authority
+from election_snapshot import load_election_snapshot
+from questions_cache import get_questions, get_canonical_questions
+from tally_checkpoints import (get_done_session_phases,
+    mark_session_phase_done, is_published, mark_published, unmark_published,
+    clear_checkpoints)
 from vmn import *
-from sha256 import hash_file, hash_data
-
-# we just use always the same timestamp for the files for creating
-# deterministic tars
-MAGIC_TIMESTAMP = 1394060400
+from sha256 import hash_file, hash_data, HashingWriter
+from tools.create_tarball import (DeterministicTarWriter, add_tally_input,
+    add_tally_manifest, write_members_manifest, TALLY_LAYOUT_EMBEDDED,
+    TALLY_LAYOUTS)
 
 # Maximum number of parameters used for an SQL Query
 LEN_QUERY_GROUP = 512
@@ -69,6 +75,7 @@ def verify_pok_plaintext(pk, proof, ciphertext):
     assert first_part == second_part
 
 @decorators.task(action="review_tally", queue="orchestra_performer")
+@timed_phase("review_tally")
 def review_tally(task):
     '''
     Generates the local private info for a new election
@@ -100,17 +107,12 @@ def review_tally(task):
     # check election has been created successfully
     election_id = data['election_id']
 
-    election = db.session.query(Election)\
-        .filter(Election.id == election_id).first()
+    election = load_election_snapshot(election_id)
     if not election:
         raise TaskError(dict(reason="election not created"))
 
     # check sender is legitimate
-    found_director = False
-    for auth in election.authorities.all():
-        if not certs_differ(auth.ssl_cert, sender_ssl_cert):
-            found_director = True
-    if not found_director:
+    if not is_election_authority(election_id, sender_ssl_cert):
         raise TaskError(dict(reason="review tally sent by an invalid authority"))
 
     private_data_path = app.config.get('PRIVATE_DATA_PATH', '')
@@ -124,6 +126,12 @@ def review_tally(task):
     if enable_multiple_tallies:
         reset_tally(election.id)
 
+    # phases completed by a previous attempt of this tally are skipped, unless
+    # the director asks to start from scratch
+    if not data.get('resume', True):
+        clear_checkpoints(election_id)
+    input_hash = data['votes_hash'].replace('ni:///sha-256;', '')
+
     if not os.path.exists(allow_disjoint_multiple_tallies) and os.path.exists(tally_path):
         raise TaskError(dict(
             reason="election already tallied and multiple tallies not allowed"
@@ -132,36 +140,121 @@ def review_tally(task):
     # TODO: check that this tally doesn't contain votes from any previous tally
 
     pubkeys = []
-    for session in election.sessions.all():
+    done_phases = dict()
+    for session in election.sessions:
         session_privpath = os.path.join(election_privpath, session.id)
         protinfo_path = os.path.join(session_privpath, 'protInfo.xml')
         pubkey_path = os.path.join(session_privpath, 'publicKey_raw')
         if not os.path.exists(protinfo_path) or not os.path.exists(pubkey_path):
             raise TaskError(dict(reason="election not created"))
 
-        # once we have checked that we have permissions to start doing the tally,
-        # we can remove the "temporal" files of any previous tally
-        ciphertexts_path = os.path.join(session_privpath, 'ciphertexts_json')
-        cipherraw_path = os.path.join(session_privpath, 'ciphertexts_raw')
-        if os.path.exists(ciphertexts_path):
-            os.unlink(ciphertexts_path)
-        if os.path.exists(cipherraw_path):
-            os.unlink(cipherraw_path)
-
         pubkey_json_path = os.path.join(session_privpath, 'publicKey_json')
         with open(pubkey_json_path, 'r') as pubkey_file:
             pubkeys.append(json.loads(pubkey_file.read()))
 
-        # reset securely
-        #subprocess.check_call(["vmn", "-reset", "privInfo.xml", "protInfo.xml",
-        #    "-f"], cwd=session_privpath)
-        v_reset(session_privpath)
+        # the outputs are only hashed again here, when resuming, and the
+        # later checks of this tally rely on their size and mtime
+        done_phases[session.id] = get_done_session_phases(election_id,
+            session.id, session_privpath, input_hash, verify_hash=True)
 
     # if there were previous tallies, remove the tally approved flag file
     approve_path = os.path.join(private_data_path, str(election_id), 'tally_approved')
     if os.path.exists(approve_path):
         os.unlink(approve_path)
 
+    sessions = election.sessions
+    ciphertexts_path = os.path.join(election_privpath, 'ciphertexts_json')
+    if all(['ingested' in phases for phases in done_phases.values()]) and\
+            os.path.exists(ciphertexts_path) and\
+            constant_time_compare(input_hash, hash_file(ciphertexts_path)):
+        print("votes already ingested, skipping download")
+    else:
+        # once we have checked that we have permissions to start doing the
+        # tally, we can remove the "temporal" files of any previous tally
+        for session in sessions:
+            session_privpath = os.path.join(election_privpath, session.id)
+            ciphertexts_path = os.path.join(session_privpath, 'ciphertexts_json')
+            cipherraw_path = os.path.join(session_privpath, 'ciphertexts_raw')
+            if os.path.exists(ciphertexts_path):
+                os.unlink(ciphertexts_path)
+            if os.path.exists(cipherraw_path):
+                os.unlink(cipherraw_path)
+
+        session_hashes = ingest_votes(data, election, election_privpath,
+            pubkeys, input_hash)
+        for session in sessions:
+            session_privpath = os.path.join(election_privpath, session.id)
+            mark_session_phase_done(election_id, session.id, session_privpath,
+                'ingested', input_hash, session_hashes[session.id])
+            done_phases[session.id] = ['ingested']
+
+    # Convert each ciphertexts_json of each session into ciphertexts_raw
+    mixed_session_ids = []
+    for session in sessions:
+        session_privpath = os.path.join(election_privpath, session.id)
+        done = done_phases[session.id]
+        if 'converted' not in done:
+            #subprocess.check_call(["vmnc", "-ciphs", "-ini", "json",
+            #    "ciphertexts_json", "ciphertexts_raw"], cwd=session_privpath)
+            v_convert_ctexts_json(session_privpath)
+            mark_session_phase_done(election_id, session.id, session_privpath,
+                'converted')
+            done = ['ingested', 'converted']
+
+        # a session already mixed with these votes keeps its mixnet state,
+        # as the director skips its mix if all the authorities mixed it
+        if 'mixed' in done:
+            print("session %s already mixed, skipping reset" % session.id)
+            mixed_session_ids.append(session.id)
+            continue
+
+        # reset securely
+        #subprocess.check_call(["vmn", "-reset", "privInfo.xml", "protInfo.xml",
+        #    "-f"], cwd=session_privpath)
+        v_reset(session_privpath)
+
+    autoaccept = app.config.get('AUTOACCEPT_REQUESTS', False)
+    if not autoaccept:
+        def str_date(date):
+            if date:
+                return date.isoformat()
+            else:
+                return ""
+
+        # request user to decide
+        label = "approve_election_tally"
+        info_text = {
+            'Title': election.title,
+            'Description': election.description,
+            'Voting period': "%s - %s" % (
+                str_date(election.start_date), 
+                str_date(election.end_date)
+            ),
+            'Question data': get_questions(election),
+            'Authorities': [auth.to_dict() for auth in election.authorities]
+        }
+        approve_task = ExternalTask(label=label,
+            data=info_text)
+        task.add(approve_task)
+
+        check_approval_task = SimpleTask(
+            receiver_url=app.config.get('ROOT_URL', ''),
+            action="check_tally_approval",
+            queue="orchestra_performer",
+            data=dict(election_id=election_id))
+        task.add(check_approval_task)
+
+    # the sessions already mixed are reported to the director
+    return dict(
+        output_data=dict(mixed_session_ids=mixed_session_ids)
+    )
+
+def ingest_votes(data, election, election_privpath, pubkeys, input_hash):
+    '''
+    Downloads the votes of the tally, checks their hash and splits them into
+    the ciphertexts_json of each session, returning the hashes of the latter
+    by session id
+    '''
     # retrieve votes/ciphertexts
     session = requests.sessions.Session()
     session.mount('http://', RejectAdapter())
@@ -180,16 +273,20 @@ def review_tally(task):
     if r.status_code != 200:
         raise TaskError(dict(reason="error downloading the votes"))
 
-    # write ciphertexts to disk
+    # write ciphertexts to disk. The previous file is unlinked instead of
+    # truncated because it might be hard linked from the public data path
     ciphertexts_path = os.path.join(election_privpath, 'ciphertexts_json')
+    if os.path.exists(ciphertexts_path):
+        os.unlink(ciphertexts_path)
     ciphertexts_file = open(ciphertexts_path, 'wb')
+    ciphertexts_writer = HashingWriter(ciphertexts_file)
     for chunk in r.iter_content(10*1024):
-        ciphertexts_file.write(chunk)
+        ciphertexts_writer.write(chunk)
     ciphertexts_file.close()
 
     # check votes hash
-    input_hash = data['votes_hash'].replace('ni:///sha-256;', '')
-    if not constant_time_compare(input_hash, hash_file(ciphertexts_path)):
+    if not constant_time_compare(input_hash,
+            ciphertexts_writer.hash_digest()):
         raise TaskError(dict(reason="invalid votes_hash"))
 
     # transform input votes into something readable by mixnet. Basically
@@ -203,6 +300,7 @@ def review_tally(task):
     # NOTE: This is the inverse of what the demociphs.py script does
     isequent_file = None
     outvotes_files = []
+    outvotes_writers = []
 
     # pubkeys needed to verify votes. we also save it to a file
     pubkeys_path = os.path.join(election_privpath, 'pubkeys_json')
@@ -211,7 +309,7 @@ def review_tally(task):
     with open(pubkeys_path, mode='w') as pubkeys_f:
         pubkeys_f.write(pubkeys_s)
 
-    sessions = election.sessions.all()
+    sessions = election.sessions
     num_questions = len(sessions)
     invalid_votes = 0
     for qnum in range(num_questions):
@@ -223,7 +321,8 @@ def review_tally(task):
         for session in sessions:
             outvotes_path = os.path.join(election_privpath, session.id,
                 'ciphertexts_json')
-            outvotes_files.append(open(outvotes_path, 'w'))
+            outvotes_files.append(open(outvotes_path, 'wb'))
+            outvotes_writers.append(HashingWriter(outvotes_files[-1]))
         print("\n------ Reading and verifying POK of plaintext for the votes..\n")
         lnum = 0
         ballots_reader = csv.reader(isequent_file, delimiter="|")
@@ -231,7 +330,7 @@ def review_tally(task):
             ballot, _voterid = line
             lnum += 1
             line_data = json.loads(ballot)
-            assert len(line_data['choices']) == len(outvotes_files)
+            assert len(line_data['choices']) == len(outvotes_writers)
 
             i = 0
             for choice in line_data['choices']:
@@ -244,8 +343,8 @@ def review_tally(task):
                     separators=(',', ':')
                 )
 
-                outvotes_files[i].write(ballot_data)
-                outvotes_files[i].write("\n")
+                outvotes_writers[i].write(ballot_data.encode('utf-8'))
+                outvotes_writers[i].write(b"\n")
                 i += 1
 
     finally:
@@ -261,46 +360,14 @@ def review_tally(task):
         for f in outvotes_files:
             f.close()
 
-    # Convert each ciphertexts_json of each session into ciphertexts_raw
-    for session in sessions:
-        session_privpath = os.path.join(election_privpath, session.id)
-        #subprocess.check_call(["vmnc", "-ciphs", "-ini", "json",
-        #    "ciphertexts_json", "ciphertexts_raw"], cwd=session_privpath)
-        v_convert_ctexts_json(session_privpath)
-
-    autoaccept = app.config.get('AUTOACCEPT_REQUESTS', False)
-    if not autoaccept:
-        def str_date(date):
-            if date:
-                return date.isoformat()
-            else:
-                return ""
-
-        # request user to decide
-        label = "approve_election_tally"
-        info_text = {
-            'Title': election.title,
-            'Description': election.description,
-            'Voting period': "%s - %s" % (
-                str_date(election.start_date), 
-                str_date(election.end_date)
-            ),
-            'Question data': loads(election.questions),
-            'Authorities': [auth.to_dict() for auth in election.authorities]
-        }
-        approve_task = ExternalTask(label=label,
-            data=info_text)
-        task.add(approve_task)
-
-        check_approval_task = SimpleTask(
-            receiver_url=app.config.get('ROOT_URL', ''),
-            action="check_tally_approval",
-            queue="orchestra_performer",
-            data=dict(election_id=election_id))
-        task.add(check_approval_task)
+    return dict(
+        (session.id, writer.hash_digest())
+        for session, writer in zip(sessions, outvotes_writers)
+    )
 
 @decorators.task(action="check_tally_approval", queue="orchestra_performer")
 @decorators.local_task
+@timed_phase("check_tally_approval")
 def check_tally_approval(task):
     '''
     Check if the tally was a approved. If it was, mark the tally as approved.
@@ -320,6 +387,7 @@ def check_tally_approval(task):
 
 
 @decorators.task(action="perform_tally", queue="mixnet_queue")
+@timed_phase("perform_tally")
 class PerformTallyTask(TaskHandler):
     def execute(self):
         '''
@@ -341,11 +409,7 @@ class PerformTallyTask(TaskHandler):
             raise TaskError(dict(reason="election not found"))
 
         # check sender is legitimate
-        found_director = False
-        for auth in election.authorities.all():
-            if not certs_differ(auth.ssl_cert, sender_ssl_cert):
-                found_director = True
-        if not found_director:
+        if not is_election_authority(election_id, sender_ssl_cert):
             raise TaskError(dict(
                 reason="perform tally task sent by an invalid authority"
             ))
@@ -362,6 +426,17 @@ class PerformTallyTask(TaskHandler):
                 raise TaskError(dict(reason="task not accepted"))
             os.unlink(tally_approved_path)
 
+        # the mix is done jointly by all the authorities, so the director
+        # asks for it whenever any of them hasn't mixed the session. If this
+        # authority had, its mix is discarded and done again with the others
+        done = get_done_session_phases(election_id, session_id,
+            session_privpath)
+        if 'mixed' in done:
+            print("session %s mixed again with the other authorities" %
+                session_id)
+            clear_checkpoints(election_id, session_id, ['mixed', 'verified'])
+            v_reset(session_privpath)
+
         # reset the whole MixNet
         mixnet_path = os.path.join(session_privpath, "dir", "MixNetElGamal")
         if os.path.exists(mixnet_path):
@@ -383,6 +458,8 @@ class PerformTallyTask(TaskHandler):
                 raise TaskError(dict(reason='error executing mixnet'))
 
         v_mix(session_privpath, output_filter)
+        mark_session_phase_done(election_id, session_id, session_privpath,
+            'mixed')
 
     def handle_error(self, error):
         '''
@@ -408,6 +485,7 @@ class PerformTallyTask(TaskHandler):
 
 
 @decorators.task(action="verify_and_publish_tally", queue="orchestra_performer")
+@timed_phase("verify_and_publish_tally")
 def verify_and_publish_tally(task):
     '''
     Once a tally has been performed, verify the result and if it's ok publish it
@@ -418,17 +496,18 @@ def verify_and_publish_tally(task):
     if election_id <= 0:
         raise TaskError(dict(reason="election_id must be positive"))
 
-    election = db.session.query(Election)\
-        .filter(Election.id == election_id).first()
+    # all the authorities must use the same layout to generate the same tally,
+    # so it's decided by the director
+    layout = input_data.get('tally_layout', TALLY_LAYOUT_EMBEDDED)
+    if layout not in TALLY_LAYOUTS:
+        raise TaskError(dict(reason="invalid tally layout"))
+
+    election = load_election_snapshot(election_id)
     if not election:
         raise TaskError(dict(reason="election not found"))
 
     # check sender is legitimate
-    found_director = False
-    for auth in election.authorities.all():
-        if not certs_differ(auth.ssl_cert, sender_ssl_cert):
-            found_director = True
-    if not found_director:
+    if not is_election_authority(election_id, sender_ssl_cert):
         raise TaskError(dict(
             reason="perform tally task sent by an invalid authority"))
 
@@ -439,12 +518,30 @@ def verify_and_publish_tally(task):
     election_pubpath = os.path.join(pubdata_path, str(election_id))
     tally_path = os.path.join(election_pubpath, 'tally.tar.gz')
     tally_hash_path = os.path.join(election_pubpath, 'tally.tar.gz.sha256')
+    tally_manifest_path = os.path.join(election_pubpath,
+        'tally.tar.gz.manifest.json')
     allow_disjoint_multiple_tallies = os.path.join(election_privpath, 'allow_disjoint_multiple_tallies')
 
     # check election_pubpath already exists - it should contain pubkey etc
     if not os.path.exists(election_pubpath):
         raise TaskError(dict(reason="election public path doesn't exist"))
 
+    # a resumed tally that was already published from the same plaintexts
+    # doesn't need to be verified and published again
+    session_ids = [session.id for session in election.sessions]
+    done_phases = dict(
+        (session_id, get_done_session_phases(election_id, session_id,
+            os.path.join(election_privpath, session_id)))
+        for session_id in session_ids
+    )
+    verified = all([
+        'verified' in done_phases[session_id]
+        for session_id in session_ids
+    ])
+    if verified and is_published(election_id, session_ids, layout, tally_path):
+        print("tally of election %d already published, skipping" % election_id)
+        return
+
     # check no tally exists yet
     if not os.path.exists(allow_disjoint_multiple_tallies):
         if os.path.exists(tally_path):
@@ -460,8 +557,13 @@ def verify_and_publish_tally(task):
         if os.path.exists(tally_hash_path):
             os.rename(tally_hash_path, new_tally_hash_path)
 
+        if os.path.exists(tally_manifest_path):
+            new_tally_manifest_path = os.path.join(election_pubpath,
+                'tally_%s.tar.gz.manifest.json' % datestr)
+            os.rename(tally_manifest_path, new_tally_manifest_path)
+
     pubkeys = []
-    for session in election.sessions.all():
+    for session in election.sessions:
         session_privpath = os.path.join(election_privpath, session.id)
         plaintexts_raw_path = os.path.join(session_privpath, 'plaintexts_raw')
         plaintexts_json_path = os.path.join(session_privpath, 'plaintexts_json')
@@ -477,6 +579,10 @@ def verify_and_publish_tally(task):
         if not os.path.exists(proofs_path) or not os.path.exists(plaintexts_raw_path):
             raise TaskError(dict(reason="proofs or plaintexts couldn't be verified"))
 
+        if 'verified' in done_phases[session.id]:
+            print("session %s already verified, skipping" % session.id)
+            continue
+
         # remove any previous plaintexts_json
         if os.path.exists(plaintexts_json_path):
             os.unlink(plaintexts_json_path)
@@ -497,6 +603,8 @@ def verify_and_publish_tally(task):
             output = e.output
         if "Verification completed SUCCESSFULLY after" not in output.decode('utf-8'):
             raise TaskError(dict(reason="invalid tally proofs"))
+        mark_session_phase_done(election_id, session.id, session_privpath,
+            'verified')
 
     # get number of invalid votes that were detected before decryption
     invalid_votes_path = os.path.join(election_privpath, 'invalid_votes')
@@ -507,108 +615,109 @@ def verify_and_publish_tally(task):
     # NOTE: we try our best to do a deterministic tally, i.e. one that can be
     # generated exactly the same bit by bit by all authorities
 
-    # For example, here we open tarfile setting cwd so that the header of the
-    # tarfile doesn't contain the full path, which would make the tally.tar.gz
-    # not deterministic as it might vary from authority to authority
-    cwd = os.getcwd()
-    try:
-        os.chdir(os.path.dirname(tally_path))
-        import time
-        old_time = time.time
-        time.time = lambda: MAGIC_TIMESTAMP
-        tar = tarfile.open(os.path.basename(tally_path), 'w|gz')
-    finally:
-        time.time = old_time
-        os.chdir(cwd)
-    timestamp = MAGIC_TIMESTAMP
+    # For example, the gzip header only contains the basename of the tally
+    # and a fixed mtime, which would otherwise vary from authority to authority
+    #
+    # The tarball is written through a HashingWriter so that we get its sha256
+    # while it's being compressed, instead of reading it back from disk
+    tally_file = open(tally_path, 'wb')
+    tally_writer = HashingWriter(tally_file)
+    tar = DeterministicTarWriter(tally_writer, os.path.basename(tally_path),
+        hash_members=True)
 
     ciphertexts_path = os.path.join(election_privpath, 'ciphertexts_json')
     pubkeys_path = os.path.join(privdata_path, str(election_id), 'pubkeys_json')
     questions_path = os.path.join(privdata_path, str(election_id), 'questions_json')
+    manifest_path = os.path.join(privdata_path, str(election_id), 'manifest_json')
+    manifest = []
 
     with open(pubkeys_path, mode='w') as pubkeys_f:
         pubkeys_f.write(json.dumps(pubkeys,
             ensure_ascii=False, sort_keys=True, indent=4, separators=(',', ': ')))
 
     with codecs.open(questions_path, encoding='utf-8', mode='w') as res_f:
-        res_f.write(json.dumps(json.loads(election.questions),
-            ensure_ascii=False, sort_keys=True, indent=4, separators=(',', ': ')))
+        res_f.write(get_canonical_questions(election))
 
-    deterministic_tar_add(tar, questions_path, 'questions_json', timestamp)
-    deterministic_tar_add(tar, ciphertexts_path, 'ciphertexts_json', timestamp)
-    deterministic_tar_add(tar, pubkeys_path, 'pubkeys_json', timestamp)
+    tar.add(questions_path, 'questions_json')
+    add_tally_input(tar, manifest, ciphertexts_path, 'ciphertexts_json',
+        election_pubpath, layout)
+    tar.add(pubkeys_path, 'pubkeys_json')
 
-    for session in election.sessions.all():
+    for session in election.sessions:
         session_privpath = os.path.join(election_privpath, session.id)
         plaintexts_json_path = os.path.join(session_privpath, 'plaintexts_json')
         proofs_path = os.path.join(session_privpath, 'dir', 'roProof')
         protinfo_path = os.path.join(session_privpath, 'protInfo.xml')
 
-        deterministic_tar_add(tar, plaintexts_json_path,
-            os.path.join(session.id, 'plaintexts_json'), timestamp)
-        deterministic_tar_add(tar, proofs_path,
-            os.path.join(session.id, "proofs"), timestamp)
-        deterministic_tar_add(tar, protinfo_path,
-            os.path.join(session.id, "protInfo.xml"), timestamp)
+        tar.add(plaintexts_json_path,
+            os.path.join(session.id, 'plaintexts_json'))
+        tar.add(proofs_path, os.path.join(session.id, "proofs"))
+        add_tally_input(tar, manifest, protinfo_path,
+            os.path.join(session.id, "protInfo.xml"), election_pubpath, layout)
+    add_tally_manifest(tar, manifest, manifest_path)
     tar.close()
+    tally_file.close()
 
     # and publish also the sha256 of the tarball
     tally_hash_file = open(tally_hash_path, 'w')
-    tally_hash_file.write(hash_file(tally_path))
+    tally_hash_file.write(tally_writer.hash_digest())
     tally_hash_file.close()
 
-def deterministic_tarinfo(tfile, filepath, arcname, timestamp, uid=1000, gid=100):
-    '''
-    Creates a tarinfo with some fixed data
-    '''
-    tarinfo = tfile.gettarinfo(filepath, arcname)
-    tarinfo.uid = uid
-    tarinfo.gid = gid
-    tarinfo.mode = 0o755 if tarinfo.isdir() else 0o644
-    tarinfo.uname = ""
-    tarinfo.gname = ""
-    tarinfo.mtime = timestamp
-    return tarinfo
-
-def deterministic_tar_add(tfile, filepath, arcname, timestamp, uid=1000, gid=100):
-    '''
-    tries its best to do a deterministic add of the file
-    '''
-    tinfo = deterministic_tarinfo(tfile, filepath, arcname, timestamp,
-        uid, gid)
-    if tinfo.isreg():
-         with open(filepath, "rb") as f:
-            tfile.addfile(tinfo, f)
-    else:
-        tfile.addfile(tinfo)
-
-    if os.path.isdir(filepath):
-        l = os.listdir(filepath)
-        l.sort() # sort or it won't be deterministic!
-        for subitem in l:
-            newpath = os.path.join(filepath, subitem)
-            newarcname = os.path.join(arcname, subitem)
-            deterministic_tar_add(tfile, newpath, newarcname, timestamp, uid,
-                gid)
+    # and the manifest with the hashes of its members, so that they can be
+    # verified independently. The manifest uses hex hashes, like the ones
+    # of its members
+    write_members_manifest(tally_manifest_path, os.path.basename(tally_path),
+        tally_writer.hexdigest(), tar.members)
+    mark_published(election_id, session_ids, layout, tally_path,
+        tally_writer.hash_digest())
 
 def reset_tally(election_id):
+    '''
+    Removes the tally files and the ballots of an election, so that it can be
+    tallied again. The ballots of each session are removed with set-based
+    deletes of at most RESET_TALLY_CHUNK_SIZE rows each, committed one by
+    one, so that neither the ballots are loaded in memory nor a single huge
+    transaction is needed.
+    '''
     # check election exists
-    election = db.session.query(Election)\
+    election = db.session.query(Election.id)\
         .filter(Election.id == election_id).first()
     if not election:
         raise TaskError(dict(reason="election not created"))
-    
+
     remove_existing_tally_files(election_id)
 
     # each session is a question
-    sessions = election.sessions.all()
-    for session in sessions:
-        ballots = session.ballots
-        for ballot in ballots:
-            db.session.delete(ballot)
-    db.session.commit()
+    session_ids = [
+        session_id
+        for session_id, in db.session.query(Session.id)\
+            .filter(Session.election_id == election_id)
+    ]
+    chunk_size = app.config.get('RESET_TALLY_CHUNK_SIZE', 10000)
+    for session_id in session_ids:
+        delete_session_ballots(session_id, chunk_size)
+
+def delete_session_ballots(session_id, chunk_size):
+    '''
+    Deletes the ballots of a session in chunks, returning how many
+    '''
+    ballots = Ballot.__table__
+    deleted = 0
+    while True:
+        chunk = select([ballots.c.ballot_hash])\
+            .where(ballots.c.session_id == session_id)\
+            .limit(chunk_size)
+        result = db.session.execute(ballots.delete().where(and_(
+            ballots.c.session_id == session_id,
+            ballots.c.ballot_hash.in_(chunk)
+        )))
+        db.session.commit()
+        deleted += result.rowcount
+        if result.rowcount < chunk_size:
+            return deleted
 
 def remove_existing_tally_files(election_id):
+    unmark_published(election_id)
     tally_path = get_tally_file_path(election_id)
     tally_hash_path = get_tally_hash_file_path(election_id)
 
@@ -618,10 +727,17 @@ def remove_existing_tally_files(election_id):
     if os.path.exists(tally_hash_path):
         os.remove(tally_hash_path)
 
+    tally_manifest_path = get_tally_manifest_file_path(election_id)
+    if os.path.exists(tally_manifest_path):
+        os.remove(tally_manifest_path)
+
 def get_tally_file_path(election_id):
     pubdata_path = app.config.get('PUBLIC_DATA_PATH', '')
     election_pubpath = os.path.join(pubdata_path, str(election_id))
     return os.path.join(election_pubpath, 'tally.tar.gz')
 
 def get_tally_hash_file_path(election_id):
-    return get_tally_file_path(election_id) + '.sha256'
\ No newline at end of file
+    return get_tally_file_path(election_id) + '.sha256'
+
+def get_tally_manifest_file_path(election_id):
+    return get_tally_file_path(election_id) + '.manifest.json'
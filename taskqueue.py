@@ -3,99 +3,903 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 #
+import io
+import os
+import uuid
+import socket
+import calendar
 import pickle
 import base64
 import json
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from frestq.app import app, db
 from frestq.utils import loads, dumps
 from frestq.tasks import SimpleTask, TaskError
-from models import Election, Authority, QueryQueue
+from models import Election, Authority, QueryQueue, ElectionArchive
+from metrics import (record_job_queued, record_job_started,
+    record_job_finished, prune_metrics)
 from create_election.performer_jobs import check_election_data
 import threading
+import traceback
+import select
+import time
+from collections import Counter
 
 
-def safe_dequeue():
-    try:
-        dequeue_task()
-        return True
-    except Exception as e:
-        return False
+# key used to tag datetimes in the JSON payloads of queued jobs
+PAYLOAD_DATETIME_TAG = '$datetime'
 
-def start_queue(queue_continue=False):
-    if not queue_continue:
-        doing = db.session.query(QueryQueue).all()
-        for i in doing:
-            i.doing = False
-            db.session.delete(i)
-    else:
-        doing = db.session.query(QueryQueue).filter(QueryQueue.doing == True)
-        for i in doing:
-            i.doing = False
+# priority classes of the queued jobs, with the head start in seconds each
+# one has over the jobs queued at the same time (see get_job_rank)
+DEFAULT_PRIORITY_CLASSES = {
+    'low': 0,
+    'normal': 3600,
+    'high': 6*3600,
+    'urgent': 7*24*3600
+}
+
+# default priority class of each type of task
+DEFAULT_TASK_PRIORITIES = {
+    'election': 'normal',
+    'tally': 'high'
+}
+
+# number of pending jobs fetched at a time when looking for the next one
+QUEUE_SCAN_BATCH = 64
+
+# times a job is queued again when its duplicate finished in the meantime
+QUEUE_DEDUP_RETRIES = 3
+
+# Postgres channel used to notify the dispatchers of other processes
+QUEUE_NOTIFY_CHANNEL = 'election_orchestra_queue'
+
+# key of the Postgres advisory lock that serializes the scheduling decisions
+# of all the processes sharing the queue
+QUEUE_ADVISORY_LOCK_KEY = 0x656f7175
+
+# id of the worker running in this process, see get_worker_id
+worker_id = None
+worker_pid = None
+
+# serializes the claiming of queued jobs inside this process
+scheduler_lock = threading.Lock()
+
+class QueueDispatcher(object):
+    '''
+    Loop that starts queued jobs in a dedicated thread. It sleeps on a
+    condition variable until notified that a job has been queued or finished
+    (see notify_queue), so work starts right away without polling.
+
+    It also wakes up every QUEUE_DISPATCHER_INTERVAL seconds as a safety net,
+    in case a notification was lost.
+    '''
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.wakeup_pending = True
+        # process that started the threads, and the threads by name
+        self.pid = None
+        self.threads = dict()
+
+    def get_thread_targets(self):
+        targets = {
+            'queue-dispatcher': self.run,
+            'queue-heartbeat': run_heartbeat
+        }
+        if is_postgres():
+            targets['queue-listener'] = listen_queue_notifications
+        return targets
+
+    def start(self):
+        '''
+        Starts the dispatcher, heartbeat and listener threads, or those of
+        them that died. They are all started again after a fork, as uwsgi
+        workers are forked from the master process and threads don't survive
+        it.
+        '''
+        if self.pid != os.getpid():
+            # the condition might have been held by a thread of the parent
+            self.condition = threading.Condition()
+            self.wakeup_pending = True
+            self.pid = os.getpid()
+            self.threads = dict()
+
+        with self.condition:
+            for name, target in self.get_thread_targets().items():
+                thread = self.threads.get(name, None)
+                if thread is not None and thread.is_alive():
+                    continue
+                thread = threading.Thread(target=target, name=name)
+                thread.daemon = True
+                thread.start()
+                self.threads[name] = thread
+
+    def wakeup(self):
+        with self.condition:
+            self.wakeup_pending = True
+            self.condition.notify()
+
+    def run(self):
+        interval = app.config.get('QUEUE_DISPATCHER_INTERVAL', 60)
+        while True:
+            with self.condition:
+                if not self.wakeup_pending:
+                    self.condition.wait(interval)
+                self.wakeup_pending = False
+
+            with app.app_context():
+                try:
+                    dequeue_task()
+                except Exception:
+                    print("ERROR dispatching queued jobs")
+                    traceback.print_exc()
+                finally:
+                    db.session.remove()
+
+
+dispatcher = QueueDispatcher()
 
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def listen_queue_notifications():
+    '''
+    Wakes up the dispatcher when other processes sharing the Postgres
+    database queue or finish a job, using LISTEN/NOTIFY on a dedicated
+    connection
+    '''
+    while True:
+        try:
+            raw_connection = db.engine.raw_connection()
+            # this connection is never returned to the pool
+            raw_connection.detach()
+            connection = raw_connection.connection
+            connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute("LISTEN %s" % QUEUE_NOTIFY_CHANNEL)
+            while True:
+                if select.select([connection], [], [], 60) != ([], [], []):
+                    connection.poll()
+                    if connection.notifies:
+                        del connection.notifies[:]
+                        dispatcher.wakeup()
+        except Exception:
+            print("ERROR listening to queue notifications, retrying..")
+            traceback.print_exc()
+            time.sleep(5)
+
+
+def get_worker_id():
+    '''
+    Returns the id of the worker running in this process. It's computed
+    again after a fork, as uwsgi workers are forked from the master process
+    '''
+    global worker_id, worker_pid
+    if worker_pid != os.getpid():
+        worker_pid = os.getpid()
+        worker_id = "%s:%d:%s" % (
+            socket.gethostname(),
+            worker_pid,
+            uuid.uuid4().hex[:8]
+        )
+    return worker_id
+
+
+def get_lease_expiration():
+    lease_seconds = app.config.get('QUEUE_LEASE_SECONDS', 300)
+    return datetime.utcnow() + timedelta(seconds=lease_seconds)
+
+
+def run_heartbeat():
+    '''
+    Renews periodically the leases of the jobs claimed by this worker, and
+    recovers the jobs whose worker died
+    '''
+    interval = app.config.get('QUEUE_HEARTBEAT_INTERVAL', 60)
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                renew_leases()
+                if recover_expired_leases():
+                    dispatcher.wakeup()
+            except Exception:
+                print("ERROR renewing queue leases")
+                traceback.print_exc()
+            finally:
+                db.session.remove()
+
+
+def renew_leases():
+    '''
+    Extends the leases of the running jobs claimed by this worker
+    '''
+    db.session.query(QueryQueue)\
+        .filter(QueryQueue.doing == True)\
+        .filter(QueryQueue.worker_id == get_worker_id())\
+        .update(
+            {QueryQueue.lease_expires_at: get_lease_expiration()},
+            synchronize_session=False
+        )
     db.session.commit()
-    t = threading.Thread(target=safe_dequeue)
-    t.start()
 
 
-def dequeue_task():
-    doing = db.session.query(QueryQueue).filter(QueryQueue.doing == True)
-    if not doing.count():
-        todo = db.session.query(QueryQueue)\
-            .with_for_update(nowait=True, of=QueryQueue)\
-            .order_by(QueryQueue.id)\
+def renew_job_lease(election_id):
+    '''
+    Hands the running job of an election to this worker, renewing its lease.
+    It's called by every phase of the frestq task of the job, so the lease
+    is kept by the process that last ran it and only expires if that process
+    dies while the task waits.
+    '''
+    if election_id is None:
+        return
+    updated = db.session.query(QueryQueue)\
+        .filter(QueryQueue.doing == True)\
+        .filter(QueryQueue.election_id == election_id)\
+        .update(
+            {
+                QueryQueue.worker_id: get_worker_id(),
+                QueryQueue.lease_expires_at: get_lease_expiration()
+            },
+            synchronize_session=False
+        )
+    db.session.commit()
+    if updated:
+        # the heartbeat of this process renews it from now on
+        dispatcher.start()
+
+
+def is_election_launched(job):
+    '''
+    Returns whether the frestq task of an election job was already launched,
+    in which case the job can't be launched again
+    '''
+    if job.task != 'election' or job.election_id is None:
+        return False
+    election = db.session.query(Election.status)\
+        .filter(Election.id == job.election_id)\
+        .first()
+    return election is not None and election.status != 'queued'
+
+
+def recover_expired_leases():
+    '''
+    Gives back to the queue the running jobs whose lease expired, because
+    the process running their task died or lost its connection. Jobs already
+    started QUEUE_MAX_ATTEMPTS times are finished with an error instead, as
+    are the elections whose creation had already started, whose sender is
+    then told that it failed.
+
+    Returns the number of jobs recovered.
+    '''
+    max_attempts = app.config.get('QUEUE_MAX_ATTEMPTS', 3)
+    failed_elections = []
+    with scheduler_lock:
+        expired = db.session.query(QueryQueue)\
+            .filter(QueryQueue.doing == True)\
+            .filter(db.or_(
+                QueryQueue.lease_expires_at == None,
+                QueryQueue.lease_expires_at < datetime.utcnow()
+            ))\
+            .with_for_update(skip_locked=True)\
+            .all()
+        for job in expired:
+            print("lease of queued job %d of worker %s expired" % (
+                job.id, job.worker_id))
+            if is_election_launched(job):
+                failed_elections.append(job.election_id)
+                record_job_finished(job.id, 'lease_expired')
+                db.session.delete(job)
+            elif (job.attempts or 0) >= max_attempts:
+                record_job_finished(job.id, 'lease_expired')
+                db.session.delete(job)
+            else:
+                job.doing = False
+                job.worker_id = None
+                job.lease_expires_at = None
+        if expired:
+            notify_queue_in_transaction()
+        db.session.commit()
+
+    if failed_elections:
+        # imported here, as create_election.director_jobs imports this module
+        from create_election.director_jobs import post_election_error
+        for election_id in failed_elections:
+            try:
+                post_election_error(election_id)
+            except Exception as e:
+                print("ERROR notifying failed election %d" % election_id, e)
+    return len(expired)
+
+
+def notify_queue():
+    '''
+    Tells the dispatcher that there might be jobs to start
+    '''
+    dispatcher.start()
+    dispatcher.wakeup()
+
+
+def notify_queue_in_transaction():
+    '''
+    With Postgres, makes the dispatchers of the other processes wake up when
+    the current transaction is committed
+    '''
+    if is_postgres():
+        db.session.execute("NOTIFY %s" % QUEUE_NOTIFY_CHANNEL)
+
+
+def start_queue():
+    '''
+    Starts consuming the queue in this process. The queue is shared by all
+    the processes and nodes using the same database, so the queued jobs are
+    kept, and the running ones are only recovered once their lease expires.
+    '''
+    recover_expired_leases()
+    migrate_legacy_payloads()
+    backfill_queue_ranks()
+    prune_metrics()
+    notify_queue()
+
+
+def get_queue_limits():
+    '''
+    Returns the global limit of running jobs and the dict with the limit per
+    task type
+    '''
+    max_running = app.config.get('QUEUE_MAX_RUNNING', 4)
+    max_running_per_task = app.config.get('QUEUE_MAX_RUNNING_PER_TASK', {})
+    return max_running, max_running_per_task
+
+
+def claim_next_job():
+    '''
+    Marks as doing and returns the next queued job that can be started without
+    exceeding the concurrency limits, or None if there's none.
+
+    Jobs run in lanes keyed by election id: a job is never started while an
+    older job of the same election is running or still queued, so the steps
+    of an election are serialized while different elections run in parallel.
+
+    Among the jobs that can be started, the one with the lowest rank is
+    chosen (see get_job_rank).
+
+    The queue can be shared by several processes and nodes using the same
+    Postgres database: the job is claimed with FOR UPDATE SKIP LOCKED and
+    leased to this worker for QUEUE_LEASE_SECONDS, see renew_leases.
+    '''
+    max_running, max_running_per_task = get_queue_limits()
+    if is_postgres():
+        # the running jobs read below must not change until the claim is
+        # committed, or two processes could both start jobs of the same
+        # election or exceed the limits
+        db.session.execute(
+            "SELECT pg_advisory_xact_lock(:key)",
+            dict(key=QUEUE_ADVISORY_LOCK_KEY)
+        )
+
+    running = db.session.query(QueryQueue)\
+        .filter(QueryQueue.doing == True)\
+        .all()
+    if len(running) >= max_running:
+        db.session.commit()
+        return None
+
+    running_per_task = Counter([job.task for job in running])
+    busy_lanes = set([
+        job.election_id
+        for job in running
+        if job.election_id is not None
+    ])
+
+    # pending jobs are walked in rank order using the (doing, rank, id) index,
+    # so usually only the first few rows are read
+    pending = db.session.query(QueryQueue)\
+        .filter(QueryQueue.doing == False)\
+        .order_by(QueryQueue.rank, QueryQueue.id)\
+        .yield_per(QUEUE_SCAN_BATCH)
+    for job in pending:
+        if job.election_id is not None:
+            if job.election_id in busy_lanes:
+                continue
+            # within a lane, jobs run in the order they were queued whatever
+            # their priority, so that i.e. a tally never overtakes the
+            # creation of its election
+            if has_older_pending_job(job):
+                continue
+            busy_lanes.add(job.election_id)
+
+        task_limit = max_running_per_task.get(job.task, max_running)
+        if running_per_task[job.task] >= task_limit:
+            continue
+
+        # rows locked by other transactions, for example a job being
+        # finished, are skipped instead of waited for
+        claimed = db.session.query(QueryQueue)\
+            .filter(QueryQueue.id == job.id)\
+            .filter(QueryQueue.doing == False)\
+            .with_for_update(skip_locked=True)\
             .first()
-        todo.doing = True
+        if claimed is None:
+            continue
+
+        claimed.doing = True
+        claimed.worker_id = get_worker_id()
+        claimed.lease_expires_at = get_lease_expiration()
+        claimed.attempts = (claimed.attempts or 0) + 1
+        record_job_started(claimed)
         db.session.commit()
+        return claimed
+
+    db.session.commit()
+    return None
+
+
+def has_older_pending_job(job):
+    '''
+    Returns whether there's a job of the same election queued before this one
+    '''
+    return db.session.query(QueryQueue.id)\
+        .filter(QueryQueue.election_id == job.election_id)\
+        .filter(QueryQueue.doing == False)\
+        .filter(QueryQueue.id < job.id)\
+        .first() is not None
+
 
-        apply_task(todo.task, todo.data)
+def get_priority_classes():
+    return app.config.get('QUEUE_PRIORITY_CLASSES', DEFAULT_PRIORITY_CLASSES)
 
 
-def queue_task(task='election', data=None):
+def get_task_priority(task):
+    '''
+    Returns the default priority class of a task type
+    '''
+    task_priorities = app.config.get('QUEUE_TASK_PRIORITIES',
+        DEFAULT_TASK_PRIORITIES)
+    return task_priorities.get(task, 'normal')
+
+
+def get_job_rank(created_at, priority):
+    '''
+    Returns the rank of a job: its queue time in seconds minus the head start
+    of its priority class. Jobs are started in rank order.
+
+    This gives aging for free: a job of a higher class only overtakes older
+    jobs of lower classes queued less than the difference of their head
+    starts before it, so low priority jobs cannot be starved. And as the rank
+    doesn't change with time, it can be indexed.
+    '''
+    head_start = get_priority_classes()[priority]
+    timestamp = calendar.timegm(created_at.utctimetuple()) +\
+        created_at.microsecond / 1e6
+    return timestamp - head_start
+
+
+def set_job_priority(job, priority):
+    '''
+    Changes the priority class of a job, updating its rank
+    '''
+    if priority not in get_priority_classes():
+        raise ValueError("invalid priority class %s" % priority)
+    job.priority = priority
+    job.rank = get_job_rank(job.created_at, priority)
+
+
+def move_job_to_front(job):
+    '''
+    Makes a pending job the next one to be considered
+    '''
+    first_rank = db.session.query(func.min(QueryQueue.rank))\
+        .filter(QueryQueue.doing == False)\
+        .scalar()
+    if first_rank is not None and first_rank <= job.rank:
+        job.rank = first_rank - 1
+
+
+def list_queue():
+    '''
+    Returns the running jobs and the pending ones, in the order in which they
+    will be considered
+    '''
+    jobs = db.session.query(QueryQueue)\
+        .order_by(QueryQueue.doing.desc(), QueryQueue.rank, QueryQueue.id)
+    return [
+        dict(
+            id=job.id,
+            task=job.task,
+            election_id=job.election_id,
+            priority=job.priority,
+            rank=job.rank,
+            created_at=job.created_at,
+            doing=job.doing,
+            worker_id=job.worker_id,
+            lease_expires_at=job.lease_expires_at,
+            attempts=job.attempts
+        )
+        for job in jobs
+    ]
+
+
+def backfill_queue_ranks():
+    '''
+    Sets the priority and rank of the jobs queued by older versions
+    '''
+    jobs = db.session.query(QueryQueue)\
+        .filter(QueryQueue.rank == None)
+    for job in jobs:
+        set_job_priority(job, get_task_priority(job.task))
+    db.session.commit()
+
+
+def dequeue_task():
+    '''
+    Starts as many queued jobs as the concurrency limits allow
+    '''
+    while True:
+        with scheduler_lock:
+            job = claim_next_job()
+        if job is None:
+            break
+        start_job(job)
+
+
+def encode_payload(data):
+    '''
+    Encodes the payload of a queued job as compact JSON. Datetimes are stored
+    explicitly as {"$datetime": "<isoformat>"}.
+    '''
+    def default(obj):
+        if isinstance(obj, datetime):
+            return {PAYLOAD_DATETIME_TAG: obj.isoformat()}
+        raise TypeError("%r can't be encoded in a queue payload" % obj)
+
+    return json.dumps(data, default=default, ensure_ascii=False,
+        separators=(',', ':'))
+
+
+def decode_payload(data):
+    '''
+    Decodes a payload encoded with encode_payload, or a legacy one
+    '''
+    if is_legacy_payload(data):
+        return decode_legacy_payload(data)
+
+    def object_hook(obj):
+        if len(obj) == 1 and PAYLOAD_DATETIME_TAG in obj:
+            return datetime.fromisoformat(obj[PAYLOAD_DATETIME_TAG])
+        return obj
+
+    return json.loads(data, object_hook=object_hook)
+
+
+class LegacyPayloadUnpickler(pickle.Unpickler):
+    '''
+    Unpickler for legacy payloads that refuses to load anything but plain
+    data and datetimes, as payloads come from HTTP requests
+    '''
+    ALLOWED_CLASSES = [
+        ('datetime', 'datetime'),
+        ('datetime', 'date'),
+        ('datetime', 'timedelta'),
+        ('datetime', 'timezone'),
+    ]
+
+    def find_class(self, module, name):
+        if (module, name) not in self.ALLOWED_CLASSES:
+            raise pickle.UnpicklingError(
+                "forbidden class %s.%s in queue payload" % (module, name))
+        return super(LegacyPayloadUnpickler, self).find_class(module, name)
+
+
+def is_legacy_payload(data):
+    '''
+    Payloads queued by older versions are a JSON string with the base64 of
+    the pickled data
+    '''
+    return data is not None and data.startswith('"')
+
+
+def decode_legacy_payload(data):
+    pickled = base64.b64decode(json.loads(data).encode('utf-8'))
+    return LegacyPayloadUnpickler(io.BytesIO(pickled)).load()
+
+
+def migrate_legacy_payloads():
+    '''
+    Re-encodes the payloads of the jobs queued by older versions. Payloads
+    that cannot be safely decoded are replaced by null, so that the job fails
+    when launched.
+    '''
+    legacy = db.session.query(QueryQueue)\
+        .filter(QueryQueue.data.like('"%'))\
+        .all()
+    dedup_keys = set()
+    for job in legacy:
+        try:
+            data = decode_legacy_payload(job.data)
+        except Exception as e:
+            print("ERROR migrating payload of queued job %d" % job.id, e)
+            job.data = encode_payload(None)
+            continue
+        job.data = encode_payload(data)
+
+        # older versions didn't store the lane nor the dedup key of the job
+        if job.election_id is None:
+            job.election_id = get_payload_election_id(job.task, data)
+        dedup_key = get_dedup_key(job.task, data)
+        if job.dedup_key is None and dedup_key is not None and\
+                dedup_key not in dedup_keys and\
+                find_duplicate_job(dedup_key) is None:
+            job.dedup_key = dedup_key
+            dedup_keys.add(dedup_key)
+    db.session.commit()
+
+
+def get_payload_election_id(task, data):
+    '''
+    Returns the id of the election of a job given its payload, or None
+    '''
+    if not isinstance(data, dict):
+        return None
+    election_id = data.get('id' if task == 'election' else 'election_id')
+    return election_id if isinstance(election_id, int) else None
+
+
+def get_dedup_key(task, data):
+    '''
+    Returns the key identifying the request of a job: elections by their id,
+    and tallies by the election id and the hash of the votes. Two requests
+    with the same key are never queued at the same time.
+    '''
+    if not isinstance(data, dict):
+        return None
+    if task == 'election' and isinstance(data.get('id'), int):
+        return "election:%d" % data['id']
+    if task == 'tally' and isinstance(data.get('election_id'), int) and\
+            isinstance(data.get('votes_hash'), str):
+        return "tally:%d:%s" % (data['election_id'], data['votes_hash'])
+    return None
+
+
+def find_duplicate_job(dedup_key):
+    '''
+    Returns the queued or running job with the given dedup key, locked until
+    the end of the transaction so that it's not finished while a request is
+    attached to it
+    '''
+    if dedup_key is None:
+        return None
+    return db.session.query(QueryQueue)\
+        .filter(QueryQueue.dedup_key == dedup_key)\
+        .with_for_update()\
+        .first()
+
+
+def attach_to_job(job, data):
+    '''
+    Attaches a duplicated tally request to the queued or running job, so that
+    its callback_url is also notified when the job finishes
+    '''
+    callback_url = data.get('callback_url', None)
+    urls = get_job_callback_urls(job)
+    if isinstance(callback_url, str) and callback_url not in urls:
+        extra_urls = json.loads(job.extra_callback_urls or '[]')
+        extra_urls.append(callback_url)
+        job.extra_callback_urls = json.dumps(extra_urls)
+    db.session.commit()
+    return job.id
+
+
+def get_job_callback_urls(job):
+    '''
+    Returns all the callback urls of a job: the one of its own request and
+    the ones of the duplicated requests attached to it
+    '''
+    urls = []
+    callback_url = decode_payload(job.data).get('callback_url', None)
+    if isinstance(callback_url, str):
+        urls.append(callback_url)
+    return urls + json.loads(job.extra_callback_urls or '[]')
+
+
+def get_running_job(election_id, job_id=None):
+    '''
+    Returns the running job with the given id, or the one of the given
+    election if job_id is None
+    '''
+    query = db.session.query(QueryQueue)\
+        .filter(QueryQueue.doing == True)
+    if job_id is not None:
+        return query.filter(QueryQueue.id == job_id).first()
+    return query.filter(QueryQueue.election_id == election_id).first()
+
+
+def get_extra_callback_urls(election_id, job_id=None):
+    '''
+    Returns the callback urls of the duplicated requests attached to the
+    running job, given by job_id or else by its election
+    '''
+    doing = get_running_job(election_id, job_id)
+    if doing is None:
+        return []
+    return json.loads(doing.extra_callback_urls or '[]')
+
+
+def new_job(task, data, election_id=None, priority=None):
+    '''
+    Creates a QueryQueue job and adds it to the db session. Raises
+    IntegrityError if an identical request is already queued.
+    '''
     data = data or {}
-    d = json.dumps(data)
-    qq = QueryQueue(task=task, data=d)
+    if priority is None:
+        priority = get_task_priority(task)
+    if priority not in get_priority_classes():
+        raise ValueError("invalid priority class %s" % priority)
+    created_at = datetime.utcnow()
+    qq = QueryQueue(
+        task=task,
+        data=encode_payload(data),
+        election_id=election_id,
+        created_at=created_at,
+        priority=priority,
+        rank=get_job_rank(created_at, priority),
+        dedup_key=get_dedup_key(task, data)
+    )
     db.session.add(qq)
+    db.session.flush()
+    record_job_queued(qq)
+    return qq
+
+
+def is_archived(election_id):
+    return db.session.query(ElectionArchive.election_id)\
+        .filter(ElectionArchive.election_id == election_id)\
+        .first() is not None
+
+
+def queue_task(task='election', data=None, election_id=None, priority=None):
+    '''
+    Queues a job and returns its id. An election whose id is already queued
+    or created is rejected with a TaskError, and a tally identical to one
+    queued or running is attached to it, returning the id of that job.
+    '''
+    if task == 'election' and isinstance(data, dict) and\
+            isinstance(data.get('id'), int) and\
+            db.session.query(Election.id)\
+                .filter(Election.id == data['id']).first() is not None:
+        raise TaskError(dict(reason='an election with id %s already '
+            'exists' % data['id']))
+    if election_id is not None and is_archived(election_id):
+        raise TaskError(dict(reason='the election with id %s is archived, '
+            'restore it first' % election_id))
+
+    dedup_key = get_dedup_key(task, data)
+    for attempt in range(QUEUE_DEDUP_RETRIES + 1):
+        try:
+            qq = new_job(task, data, election_id, priority)
+            break
+        except IntegrityError:
+            db.session.rollback()
+            duplicate = find_duplicate_job(dedup_key)
+            if duplicate is None:
+                # the duplicate finished meanwhile, so it's queued again
+                db.session.rollback()
+                if dedup_key is None or attempt == QUEUE_DEDUP_RETRIES:
+                    raise
+                continue
+            if task != 'tally':
+                db.session.rollback()
+                raise TaskError(dict(reason='an identical request is '
+                    'already queued with id %d' % duplicate.id))
+            return attach_to_job(duplicate, data)
+    notify_queue_in_transaction()
     db.session.commit()
-    safe_dequeue()
+    notify_queue()
     return qq.id
 
 
-def apply_task(task, data):
-    d = pickle.loads(base64.b64decode(data.encode('utf-8')))
+def queue_elections(elections, priority=None):
+    '''
+    Creates many elections at once, given a list of election data already
+    checked with check_election_data. The elections and authorities are
+    created and their jobs queued in a single transaction.
+
+    Returns the list of queue ids, in the same order. If any of the
+    elections is already queued, none is and a TaskError is raised.
+    '''
+    archived = db.session.query(ElectionArchive.election_id)\
+        .filter(ElectionArchive.election_id.in_([e['id'] for e in elections]))\
+        .first()
+    if archived is not None:
+        raise TaskError(dict(reason='the election with id %s is archived' %
+            archived.election_id))
+
+    jobs = []
+    try:
+        for data in elections:
+            add_election_models(data, 'queued')
+            jobs.append(new_job(
+                task='election',
+                data=dict(id=data['id'], preloaded=True),
+                election_id=data['id'],
+                priority=priority
+            ))
+    except IntegrityError:
+        db.session.rollback()
+        raise TaskError(dict(reason='some of the elections are already '
+            'queued'))
+    notify_queue_in_transaction()
+    db.session.commit()
+    notify_queue()
+    return [job.id for job in jobs]
+
+
+def start_job(job):
+    '''
+    Launches a job that has already been claimed. If it cannot be launched,
+    it's finished right away.
+    '''
+    try:
+        r = apply_task(job.task, job.data, job.id)
+    except Exception as e:
+        print("ERROR launching queued job %d" % job.id, e)
+        r = None
+
+    if not r:
+        finish_job(job.id, 'launch_error')
+
+
+def apply_task(task, data, job_id=None):
+    d = decode_payload(data)
     if task == 'election':
-        r = election_task(d)
-        if not r:
-            end_task()
+        return election_task(d, job_id)
 
     if task == 'tally':
-        r = tally_task(d)
-        if not r:
-            end_task()
+        return tally_task(d, job_id)
 
 
-def end_task():
-    doing = db.session.query(QueryQueue)\
-        .with_for_update(nowait=True)\
-        .filter(QueryQueue.doing == True)\
-        .one()
-    db.session.delete(doing)
-    db.session.commit()
-    safe_dequeue()
+def finish_job(job_id, outcome='success'):
+    '''
+    Removes a finished job from the queue, recording its outcome, and starts
+    the next ones
+    '''
+    with scheduler_lock:
+        record_job_finished(job_id, outcome)
+        db.session.query(QueryQueue)\
+            .filter(QueryQueue.id == job_id)\
+            .delete()
+        notify_queue_in_transaction()
+        db.session.commit()
+    notify_queue()
 
 
-### TASKS
+def end_task(election_id, outcome='success', job_id=None):
+    '''
+    Called when the running job of the given election finishes, either
+    successfully or with an error, given by outcome. The job is identified
+    by job_id, or by the election for the tasks launched by older versions.
+    '''
+    if job_id is None:
+        doing = get_running_job(election_id)
+        if doing is None:
+            print("no running job for election %s" % election_id)
+            notify_queue()
+            return
+        job_id = doing.id
 
-def election_task(data):
-    if not data:
-        print("invalid json")
-        return False
+    finish_job(job_id, outcome)
 
-    try:
-        check_election_data(data, True)
-    except Exception as e:
-        print("ERROR", e)
-        return False
 
+### TASKS
+
+def add_election_models(data, status):
+    '''
+    Adds to the db session the election and authorities described by data,
+    already checked with check_election_data
+    '''
     e = Election(
         id = data['id'],
         title = data['title'][:255],
@@ -106,7 +910,7 @@ def election_task(data):
         callback_url = data['callback_url'],
         num_parties = len(data['authorities']),
         threshold_parties = len(data['authorities']),
-        status = 'creating'
+        status = status
     )
     db.session.add(e)
 
@@ -118,6 +922,30 @@ def election_task(data):
             election_id = data['id']
         )
         db.session.add(authority)
+
+
+def election_task(data, job_id=None):
+    if not data:
+        print("invalid json")
+        return False
+
+    if data.get('preloaded', False):
+        # queued by a bulk request, so the election was already checked and
+        # created in the db
+        election = db.session.query(Election)\
+            .filter(Election.id == data.get('id', None)).first()
+        if election is None or election.status != 'queued':
+            print("invalid preloaded election %s" % data.get('id', None))
+            return False
+        election.status = 'creating'
+    else:
+        try:
+            check_election_data(data, True)
+        except Exception as e:
+            print("ERROR", e)
+            return False
+
+        add_election_models(data, 'creating')
     db.session.commit()
 
     task = SimpleTask(
@@ -125,14 +953,15 @@ def election_task(data):
         action="create_election",
         queue="launch_task",
         data={
-            'election_id': data['id']
+            'election_id': data['id'],
+            'job_id': job_id
         }
     )
     task.create_and_send()
     return task
 
 
-def tally_task(data):
+def tally_task(data, job_id=None):
     if not data:
         print("invalid json")
         return False
@@ -159,6 +988,10 @@ def tally_task(data):
         print("invalid votes_hash, must be sha256")
         return False
 
+    if not isinstance(data.get('resume', True), bool):
+        print("invalid resume parameter")
+        return False
+
     election_id = data['election_id']
     election = db.session.query(Election)\
         .filter(Election.id == election_id).first()
@@ -175,6 +1008,8 @@ def tally_task(data):
             'callback_url': data['callback_url'],
             'votes_url': data['votes_url'],
             'votes_hash': data['votes_hash'],
+            'resume': data.get('resume', True),
+            'job_id': job_id,
         }
     )
     task.create_and_send()
@@ -8,14 +8,18 @@
 #
 import os
 import re
+import gzip
 import tarfile
 import codecs
 import hashlib
+import binascii
 import subprocess
 import json
 import requests
 import shutil
+import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from frestq.app import app, db
 from frestq import decorators
@@ -27,6 +31,7 @@ from frestq.action_handlers import TaskHandler
 from models import Election, Authority, Session
 from utils import *
 from vmn import *
+from sha256 import HashingWriter, HashingReader
 
 
 BUF_SIZE = 10*1024
@@ -35,6 +40,15 @@ BUF_SIZE = 10*1024
 # deterministic tars
 MAGIC_TIMESTAMP = 1394060400
 
+# tally layouts. With the embedded layout, every input of the tally is
+# included in the tally tarball. With the referenced layout, the big inputs
+# that don't change between tallies are published once as content-addressed
+# files in the election public path, and the tarball only includes a
+# manifest_json with their hashes.
+TALLY_LAYOUT_EMBEDDED = 'embedded'
+TALLY_LAYOUT_REFERENCED = 'referenced'
+TALLY_LAYOUTS = [TALLY_LAYOUT_EMBEDDED, TALLY_LAYOUT_REFERENCED]
+
 def hash_bytes(bytes):
     '''
     Returns the hexdigest of the hash of the bytes
@@ -89,13 +103,18 @@ def verify_pok_plaintext(pk, proof, ciphertext):
     # check g^response == commitment * (g^t) ^ challenge == commitment * (alpha) ^ challenge
     assert first_part == second_part
 
-def create(election_id):
+def create(election_id, layout=None):
     '''
     create the tarball
     '''
     if not re.match("^[a-zA-Z0-9_-]+$", election_id):
         raise TaskError(dict(reason="invalid characters in election_id"))
 
+    if layout is None:
+        layout = app.config.get('TALLY_LAYOUT', TALLY_LAYOUT_EMBEDDED)
+    if layout not in TALLY_LAYOUTS:
+        raise TaskError(dict(reason="invalid tally layout %s" % layout))
+
     election = db.session.query(Election)\
         .filter(Election.id == election_id).first()
     if not election:
@@ -108,6 +127,8 @@ def create(election_id):
     election_pubpath = os.path.join(pubdata_path, election_id)
     tally_path = os.path.join(election_pubpath, 'tally.tar.gz')
     tally_hash_path = os.path.join(election_pubpath, 'tally.tar.gz.sha256')
+    tally_manifest_path = os.path.join(election_pubpath,
+        'tally.tar.gz.manifest.json')
 
     # check election_pubpath already exists - it should contain pubkey etc
     if not os.path.exists(election_pubpath):
@@ -156,30 +177,28 @@ def create(election_id):
     # NOTE: we try our best to do a deterministic tally, i.e. one that can be
     # generated exactly the same bit by bit by all authorities
 
-    # For example, here we open tarfile setting cwd so that the header of the
-    # tarfile doesn't contain the full path, which would make the tally.tar.gz
-    # not deterministic as it might vary from authority to authority
-    cwd = os.getcwd()
-    try:
-        os.chdir(os.path.dirname(tally_path))
-        import time
-        old_time = time.time
-        time.time = lambda: MAGIC_TIMESTAMP
-        tar = tarfile.open(os.path.basename(tally_path), 'w|gz')
-    finally:
-        time.time = old_time
-        os.chdir(cwd)
-    timestamp = MAGIC_TIMESTAMP
+    # For example, the gzip header only contains the basename of the tally
+    # and a fixed mtime, which would otherwise vary from authority to authority
+    #
+    # The tarball is written through a HashingWriter so that we get its sha256
+    # while it's being compressed, instead of reading it back from disk
+    tally_file = open(tally_path, 'wb')
+    tally_writer = HashingWriter(tally_file)
+    tar = DeterministicTarWriter(tally_writer, os.path.basename(tally_path),
+        hash_members=True)
 
     ciphertexts_path = os.path.join(election_privpath, 'ciphertexts_json')
     pubkeys_path = os.path.join(privdata_path, election_id, 'pubkeys_json')
+    manifest_path = os.path.join(privdata_path, election_id, 'manifest_json')
+    manifest = []
 
     with open(pubkeys_path, mode='w') as pubkeys_f:
         pubkeys_f.write(json.dumps(pubkeys,
             ensure_ascii=False, sort_keys=True, indent=4, separators=(',', ': ')))
 
-    deterministic_tar_add(tar, ciphertexts_path, 'ciphertexts_json', timestamp)
-    deterministic_tar_add(tar, pubkeys_path, 'pubkeys_json', timestamp)
+    add_tally_input(tar, manifest, ciphertexts_path, 'ciphertexts_json',
+        election_pubpath, layout)
+    tar.add(pubkeys_path, 'pubkeys_json')
 
     for session in election.sessions.all():
         session_privpath = os.path.join(election_privpath, session.id)
@@ -187,20 +206,82 @@ def create(election_id):
         proofs_path = os.path.join(session_privpath, 'dir', 'roProof')
         protinfo_path = os.path.join(session_privpath, 'protInfo.xml')
 
-        deterministic_tar_add(tar, plaintexts_json_path,
-            os.path.join(session.id, 'plaintexts_json'), timestamp)
-        deterministic_tar_add(tar, proofs_path,
-            os.path.join(session.id, "proofs"), timestamp)
-        deterministic_tar_add(tar, protinfo_path,
-            os.path.join(session.id, "protInfo.xml"), timestamp)
+        tar.add(plaintexts_json_path,
+            os.path.join(session.id, 'plaintexts_json'))
+        tar.add(proofs_path, os.path.join(session.id, "proofs"))
+        add_tally_input(tar, manifest, protinfo_path,
+            os.path.join(session.id, "protInfo.xml"), election_pubpath, layout)
+    add_tally_manifest(tar, manifest, manifest_path)
     tar.close()
+    tally_file.close()
 
     # and publish also the sha256 of the tarball
     tally_hash_file = open(tally_hash_path, 'w')
-    tally_hash_file.write(hash_file(tally_path))
+    tally_hash_file.write(tally_writer.hexdigest())
     tally_hash_file.close()
+
+    # and the manifest with the hashes of its members
+    write_members_manifest(tally_manifest_path, os.path.basename(tally_path),
+        tally_writer.hexdigest(), tar.members)
     print("tally = %s" % tally_path)
 
+def parse_election_ids(args):
+    '''
+    Parses a list of election ids and inclusive ranges of them, like
+    ["1", "5-8", "10,12"], into a sorted list of unique election ids
+    '''
+    election_ids = set()
+    for arg in args:
+        for item in arg.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            match = re.match("^([0-9]+)-([0-9]+)$", item)
+            if match:
+                start, end = int(match.group(1)), int(match.group(2))
+                if start > end:
+                    raise ValueError("invalid election id range %s" % item)
+                election_ids.update(range(start, end + 1))
+            elif re.match("^[0-9]+$", item):
+                election_ids.add(int(item))
+            else:
+                raise ValueError("invalid election id %s" % item)
+    return sorted(election_ids)
+
+def create_batch(election_ids, jobs=4, layout=None):
+    '''
+    Rebuilds the tally tarball of many elections with a pool of worker
+    threads, sharing the app and database initialization.
+
+    Returns a dict with the result of each election (status, error and timing
+    in seconds), ready to be dumped as JSON.
+    '''
+    def create_one(election_id):
+        start = time.time()
+        result = dict(election_id=election_id)
+        with app.app_context():
+            try:
+                create(str(election_id), layout)
+                result['status'] = 'ok'
+            except Exception as e:
+                result['status'] = 'error'
+                result['error'] = str(e)
+            finally:
+                db.session.remove()
+        result['seconds'] = round(time.time() - start, 3)
+        return result
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(create_one, election_ids))
+
+    return dict(
+        results=results,
+        total=len(results),
+        failed=len([r for r in results if r['status'] != 'ok']),
+        seconds=round(time.time() - start, 3)
+    )
+
 def deterministic_tarinfo(tfile, filepath, arcname, timestamp, uid=1000, gid=100):
     '''
     Creates a tarinfo with some fixed data
@@ -214,43 +295,202 @@ def deterministic_tarinfo(tfile, filepath, arcname, timestamp, uid=1000, gid=100
     tarinfo.mtime = timestamp
     return tarinfo
 
-def deterministic_tar_add(tfile, filepath, arcname, timestamp, uid=1000, gid=100):
+def deterministic_tar_add(tfile, filepath, arcname, timestamp, uid=1000, gid=100,
+                          members=None, recursive=True):
     '''
     tries its best to do a deterministic add of the file
+
+    If members is a list, a dict with the name, sha256 and size of each
+    regular file added is appended to it. If recursive is False, only the
+    entry of a directory is added, without its contents.
     '''
     tinfo = deterministic_tarinfo(tfile, filepath, arcname, timestamp,
         uid, gid)
     if tinfo.isreg():
          with open(filepath, "rb") as f:
-            tfile.addfile(tinfo, f)
+            if members is not None:
+                reader = HashingReader(f)
+                tfile.addfile(tinfo, reader)
+                members.append(dict(
+                    name=tinfo.name,
+                    sha256=reader.hexdigest(),
+                    size=tinfo.size
+                ))
+            else:
+                tfile.addfile(tinfo, f)
     else:
         tfile.addfile(tinfo)
 
-    if os.path.isdir(filepath):
+    if recursive and os.path.isdir(filepath):
         l = os.listdir(filepath)
         l.sort() # sort or it won't be deterministic!
         for subitem in l:
             newpath = os.path.join(filepath, subitem)
             newarcname = os.path.join(arcname, subitem)
             deterministic_tar_add(tfile, newpath, newarcname, timestamp, uid,
-                gid)
+                gid, members)
+
+def merkle_root(leaves):
+    '''
+    Returns the hexdigest of the root of the Merkle tree of the given list of
+    leaf data (bytes), computed as in RFC 6962 section 2.1:
+
+        MTH({}) = SHA-256()
+        MTH({d0}) = SHA-256(0x00 || d0)
+        MTH(D[n]) = SHA-256(0x01 || MTH(D[0:k]) || MTH(D[k:n]))
+
+    where k is the largest power of two smaller than n.
+    '''
+    def tree_hash(items):
+        if len(items) == 0:
+            return hashlib.sha256().digest()
+        if len(items) == 1:
+            return hashlib.sha256(b'\x00' + items[0]).digest()
+        k = 1
+        while k * 2 < len(items):
+            k *= 2
+        return hashlib.sha256(
+            b'\x01' + tree_hash(items[:k]) + tree_hash(items[k:])
+        ).digest()
+
+    return binascii.hexlify(tree_hash(leaves)).decode('utf-8')
+
+def member_leaf(member):
+    '''
+    Leaf data of a member of an archive for its Merkle tree: its name and the
+    binary sha256 of its contents, separated by a NUL byte
+    '''
+    return member['name'].encode('utf-8') + b'\x00' +\
+        binascii.unhexlify(member['sha256'])
+
+def write_members_manifest(manifest_path, archive_name, archive_hash, members):
+    '''
+    Writes the deterministic manifest of an archive, listing each of its
+    regular file members (in archive order) with their sha256 and size, and
+    the Merkle root over them, so that any member can be verified without
+    downloading and hashing the whole archive.
+
+    All the hashes of the manifest, including archive_hash, are hex encoded
+    sha256 digests, whatever the format of the .sha256 file of the archive.
+    '''
+    manifest = dict(
+        archive=archive_name,
+        archive_hash=archive_hash,
+        members=members,
+        merkle_root=merkle_root([member_leaf(m) for m in members]),
+        merkle_tree="rfc6962-sha256, leaf = name || 0x00 || sha256(content)"
+    )
+    with open(manifest_path, mode='w') as manifest_f:
+        manifest_f.write(json.dumps(manifest,
+            ensure_ascii=False, sort_keys=True, indent=4,
+            separators=(',', ': ')))
+
+class DeterministicTarWriter(object):
+    '''
+    Writes a deterministic tar.gz stream into a file object.
+
+    The gzip header mtime and filename are given explicitly, so contrary to
+    tarfile.open(name, 'w|gz') there is no need to patch time.time or to
+    chdir, and different archives can be written concurrently from different
+    threads.
+
+    If hash_members is True, the name, sha256 and size of each regular file
+    added is recorded in self.members (see write_members_manifest).
+
+    Members are always copied through python: the stream is gzip compressed,
+    so they can't be copied in the kernel with copy_file_range or sendfile.
+    '''
+    def __init__(self, fileobj, filename, mtime=MAGIC_TIMESTAMP, uid=1000,
+                 gid=100, hash_members=False):
+        self.mtime = mtime
+        self.uid = uid
+        self.gid = gid
+        self.members = [] if hash_members else None
+        # same gzip parameters tarfile uses, so the output is bit by bit the
+        # same as the one of tarfile.open(filename, 'w|gz') at time mtime
+        self.gzip_file = gzip.GzipFile(filename=filename, mode='wb',
+            compresslevel=9, fileobj=fileobj, mtime=mtime)
+        self.tar = tarfile.open(mode='w|', fileobj=self.gzip_file)
+
+    def add(self, filepath, arcname, recursive=True):
+        deterministic_tar_add(self.tar, filepath, arcname, self.mtime,
+            self.uid, self.gid, self.members, recursive)
+
+    def close(self):
+        '''
+        Finishes the archive. Note that fileobj is not closed.
+        '''
+        try:
+            self.tar.close()
+        finally:
+            self.gzip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def publish_content_addressed(file_path, election_pubpath):
+    '''
+    Publishes file_path as election_pubpath/objects/<sha256 hexdigest>, unless
+    it was already published, and returns the manifest entry referencing it.
+    '''
+    file_hash = hash_file(file_path, mode='rb')
+    objects_path = os.path.join(election_pubpath, 'objects')
+    object_path = os.path.join(objects_path, file_hash)
+    if not os.path.exists(objects_path):
+        mkdir_recursive(objects_path)
+    if not os.path.exists(object_path):
+        publish_file(file_path, object_path)
+
+    return dict(
+        sha256=file_hash,
+        size=os.path.getsize(file_path),
+        path='objects/' + file_hash
+    )
+
+def add_tally_input(tar, manifest, file_path, arcname, election_pubpath,
+                    layout):
+    '''
+    Adds one of the big inputs of the tally that don't change between tallies
+    (ciphertexts and protInfo.xml files) to the tally tarball, or if the
+    layout is TALLY_LAYOUT_REFERENCED, publishes it as a content-addressed
+    file and adds its entry to the manifest list instead.
+    '''
+    if layout == TALLY_LAYOUT_REFERENCED:
+        entry = publish_content_addressed(file_path, election_pubpath)
+        entry['name'] = arcname
+        manifest.append(entry)
+    else:
+        tar.add(file_path, arcname)
+
+def add_tally_manifest(tar, manifest, manifest_path):
+    '''
+    Writes the manifest of the referenced inputs of the tally, if any, and
+    adds it to the tally tarball as manifest_json
+    '''
+    if not manifest:
+        return
+
+    with open(manifest_path, mode='w') as manifest_f:
+        manifest_f.write(json.dumps(dict(referenced_files=manifest),
+            ensure_ascii=False, sort_keys=True, indent=4,
+            separators=(',', ': ')))
+    tar.add(manifest_path, 'manifest_json')
 
 # tarfile_path: ie /home/user/file.tar.gz
-def create_deterministic_tar_file(tarfile_path, folder_path):
-    cwd = os.getcwd()
-    try:
-        os.chdir(os.path.dirname(tarfile_path))
-        import time
-        old_time = time.time
-        time.time = lambda: MAGIC_TIMESTAMP
-        tar = tarfile.open(os.path.basename(tarfile_path), 'w|gz')
-    finally:
-        time.time = old_time
-        os.chdir(cwd)
-    timestamp = MAGIC_TIMESTAMP
-
-    deterministic_tar_add(tar, folder_path, '', timestamp)
-    tar.close()
+# fileobj: if given, the tar is written to it instead of to tarfile_path, which
+# is then only used to name the gzip stream. It can be a HashingWriter.
+def create_deterministic_tar_file(tarfile_path, folder_path, fileobj=None):
+    filename = os.path.basename(tarfile_path)
+    if fileobj is not None:
+        with DeterministicTarWriter(fileobj, filename) as tar:
+            tar.add(folder_path, '')
+    else:
+        with open(tarfile_path, 'wb') as tar_file:
+            with DeterministicTarWriter(tar_file, filename) as tar:
+                tar.add(folder_path, '')
 
 def extract_tar_file(tar_file_path, target_extract_folder):
     with tarfile.open(tar_file_path) as tar_file:
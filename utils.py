@@ -6,10 +6,15 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 #
 import os
+import errno
+import fcntl
+import shutil
 import signal
 import time
 import subprocess
+import ssl
 import hashlib
+import functools
 
 from frestq.app import app
 from asyncproc import Process
@@ -26,6 +31,59 @@ def mkdir_recursive(path):
             if not os.path.exists(p):
                 os.mkdir(p, 0o755)
 
+# ioctl to clone a file in copy-on-write filesystems (btrfs, xfs..),
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# errors meaning that a link or kernel-side copy can't be done between those
+# files, in which case we fall back to a slower method
+KERNEL_COPY_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EPERM, errno.EBADF)
+
+def publish_file(src_path, dst_path):
+    '''
+    Publishes a copy of src_path in dst_path, replacing it atomically if it
+    already exists.
+
+    Depending on the PUBLISH_FILE_MODE setting, it uses:
+     - "hardlink": a hard link to the same file, so it requires both paths to
+       be in the same filesystem and src_path must not be modified afterwards
+     - "reflink": a copy-on-write clone of the file (btrfs, xfs..)
+     - "copy": a regular copy
+
+    If the method cannot be used, it tries with the next one in the list,
+    ending with a regular copy, which is always possible.
+    '''
+    mode = app.config.get('PUBLISH_FILE_MODE', 'reflink')
+    tmp_path = dst_path + '.publishing'
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+
+    done = False
+    if mode == 'hardlink':
+        try:
+            os.link(src_path, tmp_path)
+            done = True
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_UNSUPPORTED_ERRNOS + (errno.EMLINK,):
+                raise
+
+    if not done and mode in ['hardlink', 'reflink']:
+        try:
+            with open(src_path, 'rb') as src_file,\
+                    open(tmp_path, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            done = True
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_UNSUPPORTED_ERRNOS:
+                raise
+
+    if not done:
+        # note that shutil.copyfile already uses sendfile when possible
+        shutil.copyfile(src_path, tmp_path)
+
+    os.replace(tmp_path, dst_path)
+
 def get_server_url():
     '''
     Return a server url that can be used
@@ -90,3 +148,19 @@ def constant_time_compare(val1, val2):
     for x, y in zip(val1, val2):
         result |= ord(x) ^ ord(y)
     return result == 0
+
+
+@functools.lru_cache(maxsize=1024)
+def cert_fingerprint(ssl_cert):
+    '''
+    Returns the sha256 hexdigest of the DER encoding of a PEM certificate,
+    which doesn't depend on how the PEM is formatted, or None if it's not a
+    valid certificate
+    '''
+    if not ssl_cert:
+        return None
+    try:
+        der_cert = ssl.PEM_cert_to_DER_cert(ssl_cert.strip())
+    except Exception:
+        return None
+    return hashlib.sha256(der_cert).hexdigest()